@@ -1,124 +1,346 @@
 import asyncio
+import contextlib
+import csv
+import hashlib
+import json
 import logging
+import os
+import sqlite3
 import time
-from asyncio import Queue
-from typing import List
 from asyncua import Client, ua
-import pandas as pd
+
+# Used when the server does not announce MaxNodesPerBrowse.
+DEFAULT_MAX_NODES_PER_BROWSE = 1000
+# References per node in one Browse response; the rest is fetched with BrowseNext.
+MAX_REFERENCES_PER_NODE = 1000
+DEFAULT_MAX_CONCURRENT_BROWSES = 4
+# Seconds per request; large Browse and Read batches take longer than asyncua's default of 4,
+# and keep the server too busy to answer the session watchdog within its default of 1.
+REQUEST_TIMEOUT = 30
+# With an unchanged server start time only the top of the cached tree is compared with the server.
+VERIFY_DEPTH = 2
+# Used when the server does not announce MaxNodesPerRead.
+DEFAULT_MAX_NODES_PER_READ = 1000
+MAX_CONCURRENT_READS = 4
+OUTPUT_COLUMNS = ["NodeId", "BrowseName", "ParentNodeId", "DataType", "DisplayName", "Description"]
+NODES_COLUMNS = ["DisplayName", "NodeId", "DataType"]
+EXPORT_ATTRIBUTES = (ua.AttributeIds.BrowseName, ua.AttributeIds.DisplayName, ua.AttributeIds.NodeClass, ua.AttributeIds.Description, ua.AttributeIds.DataType)
+
+def children_digest(child_ids):
+    return hashlib.sha1("\n".join(sorted(child_ids)).encode()).hexdigest()
+
+class NodeCache:
+    # Browse results of one server kept in SQLite, so later startups only re-browse subtrees that
+    # changed. Nodes that were discovered but not browsed yet (browsed = 0) are the browse queue;
+    # it is committed after every batch, so an interrupted browse resumes where it stopped.
+    # Every node is stored once, under the first parent it was discovered from.
+    def __init__(self, path=":memory:"):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                parent_id TEXT,
+                namespace INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                browsed INTEGER NOT NULL DEFAULT 0,
+                child_count INTEGER,
+                children TEXT,
+                exported INTEGER NOT NULL DEFAULT 0,
+                csv_row TEXT
+            );
+            CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent_id);
+            CREATE INDEX IF NOT EXISTS nodes_browsed ON nodes (browsed);
+        """)
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def reset(self, identity):
+        self.db.execute("DELETE FROM nodes")
+        self.db.execute("DELETE FROM meta")
+        self.set_meta("identity", identity)
+        self.set_meta("dirty", "1")
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def count(self, namespace=None):
+        if namespace is None:
+            return self.db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM nodes WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def add_root(self, node_id, namespace):
+        if self.db.execute("INSERT OR IGNORE INTO nodes (node_id, namespace, depth) VALUES (?, ?, 0)", (node_id, namespace)).rowcount:
+            self.set_meta("dirty", "1")
+
+    def pending(self, limit):
+        # Unbrowsed nodes in discovery order, which keeps the browse breadth-first.
+        return self.db.execute("SELECT node_id, depth FROM nodes WHERE browsed = 0 ORDER BY rowid LIMIT ?", (limit,)).fetchall()
+
+    def pending_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM nodes WHERE browsed = 0").fetchone()[0]
+
+    def set_children(self, node_id, depth, children):
+        # children: [(node_id, namespace)]
+        self.db.executemany("INSERT OR IGNORE INTO nodes (node_id, parent_id, namespace, depth) VALUES (?, ?, ?, ?)",
+                            [(child_id, node_id, namespace, depth + 1) for child_id, namespace in children])
+        self.db.execute("UPDATE nodes SET browsed = 1, child_count = ?, children = ? WHERE node_id = ?",
+                        (len(children), children_digest([child_id for child_id, _ in children]), node_id))
+        self.set_meta("dirty", "1")
+
+    def branches(self, max_depth=None):
+        # Browsed nodes that had children, top-down.
+        return self.db.execute("SELECT node_id, children FROM nodes WHERE browsed = 1 AND child_count > 0 AND depth <= ? ORDER BY depth, rowid",
+                               (max_depth if max_depth is not None else 2 ** 31,)).fetchall()
+
+    def exists(self, node_id):
+        return self.db.execute("SELECT 1 FROM nodes WHERE node_id = ?", (node_id,)).fetchone() is not None
+
+    def invalidate(self, node_id):
+        # Drops everything below node_id and queues it to be browsed again.
+        self.db.execute("""
+            WITH RECURSIVE subtree(node_id) AS (
+                SELECT node_id FROM nodes WHERE parent_id = ?
+                UNION ALL SELECT nodes.node_id FROM nodes JOIN subtree ON nodes.parent_id = subtree.node_id
+            ) DELETE FROM nodes WHERE node_id IN subtree""", (node_id,))
+        self.db.execute("UPDATE nodes SET browsed = 0 WHERE node_id = ?", (node_id,))
+        self.set_meta("dirty", "1")
+
+    def unexported_count(self, namespace):
+        return self.db.execute("SELECT COUNT(*) FROM nodes WHERE namespace = ? AND exported = 0", (namespace,)).fetchone()[0]
+
+    def page(self, namespace, after_rowid, limit):
+        # Nodes of a namespace in browse order, a page at a time, so callers never hold them all.
+        return self.db.execute("SELECT rowid, node_id, parent_id, csv_row FROM nodes WHERE namespace = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                               (namespace, after_rowid, limit)).fetchall()
+
+    def set_row(self, node_id, row):
+        self.db.execute("UPDATE nodes SET exported = 1, csv_row = ? WHERE node_id = ?", (json.dumps(row), node_id))
+        self.set_meta("dirty", "1")
+
+    def mark_unexported(self):
+        self.db.execute("UPDATE nodes SET exported = 0, csv_row = NULL")
 
 class NodeCSVExporter:
-    def __init__(self, server_url: str, output_file: str, namespace_filter: int = 2, print_callback=None):
+    def __init__(self, server_url: str, output_file: str, namespace_filter: int = 2, print_callback=None, cache_file: str = ":memory:", nodes_file: str = None,
+                 browse_sessions: int = 1, max_concurrent_browses: int = DEFAULT_MAX_CONCURRENT_BROWSES, node_class_mask: int = 0):
         self.server_url = server_url
         self.output_file = output_file
+        # Optional second output with only the columns the node selection page needs.
+        self.nodes_file = nodes_file
         self.namespace_filter = namespace_filter
-        self.nodes: List[ua.Node] = []
+        # Browse requests are spread over browse_sessions sessions, max_concurrent_browses in flight
+        # at a time. node_class_mask (ua.NodeClass bits, 0 = all) filters children on the server.
+        self.browse_sessions = max(1, browse_sessions)
+        self.max_concurrent_browses = max(1, max_concurrent_browses)
+        self.node_class_mask = node_class_mask
         self.client: Client = None
-        self.node_queue: Queue = Queue()
+        self.browse_clients = []
+        self.max_nodes_per_browse = DEFAULT_MAX_NODES_PER_BROWSE
+        self.cache = NodeCache(cache_file)
         self.start_time = time.time()
         self.print_callback = print_callback
 
-    async def start_node_browse(self, rootnode):
-        await self.node_queue.put(rootnode)
-        total_processed = 0
-        processed_nodes = set()
-        while not self.node_queue.empty():
-            batch = []
-            for _ in range(min(100, self.node_queue.qsize())):
-                if not self.node_queue.empty():
-                    node = await self.node_queue.get()
-                    if node not in processed_nodes:
-                        batch.append(node)
-                        processed_nodes.add(node)
-
-            self.nodes.extend(batch)
-            total_processed += len(batch)
+    def report(self, message):
+        if self.print_callback:
+            self.print_callback(message)
 
-            children_tasks = [node.get_children() for node in batch]
-            children_results = await asyncio.gather(*children_tasks)
+    async def browse_children(self, node_ids, client):
+        # Children of every node in one Browse request (following continuation points with
+        # BrowseNext), as lists of (node_id, namespace). Nodes the server cannot browse get none.
+        params = ua.BrowseParameters()
+        params.RequestedMaxReferencesPerNode = MAX_REFERENCES_PER_NODE
+        params.NodesToBrowse = [ua.BrowseDescription(
+            NodeId=ua.NodeId.from_string(node_id),
+            BrowseDirection=ua.BrowseDirection.Forward,
+            ReferenceTypeId=ua.NodeId(ua.ObjectIds.HierarchicalReferences),
+            IncludeSubtypes=True,
+            NodeClassMask=self.node_class_mask,
+            ResultMask=ua.BrowseResultMask.None_,
+        ) for node_id in node_ids]
+        results = enumerate(await client.uaclient.browse(params))
+        children = [[] for _ in node_ids]
+        while True:
+            continuation = []
+            for index, result in results:
+                if not result.StatusCode.is_good():
+                    logging.error(f"Error browsing node {node_ids[index]}: {result.StatusCode.name}")
+                    continue
+                children[index].extend((reference.NodeId.to_string(), reference.NodeId.NamespaceIndex) for reference in result.References)
+                if result.ContinuationPoint:
+                    continuation.append((index, result.ContinuationPoint))
+            if not continuation:
+                return children
+            next_params = ua.BrowseNextParameters()
+            next_params.ContinuationPoints = [point for _, point in continuation]
+            results = zip([index for index, _ in continuation], await client.uaclient.browse_next(next_params))
 
-            for children in children_results:
-                for child in children:
-                    if child not in processed_nodes:
-                        await self.node_queue.put(child)
+    async def browse_wave(self, node_ids):
+        # Browses node_ids with up to max_concurrent_browses requests in flight, round-robin over the sessions.
+        size = self.max_nodes_per_browse
+        requests = [node_ids[i:i + size] for i in range(0, len(node_ids), size)]
+        results = await asyncio.gather(*[self.browse_children(request, self.browse_clients[i % len(self.browse_clients)]) for i, request in enumerate(requests)])
+        return [children for request_children in results for children in request_children]
 
-            for _ in batch:
-                self.node_queue.task_done()
+    async def start_node_browse(self, rootnode):
+        # Browses every queued node in the cache, starting from rootnode on an empty cache.
+        self.cache.add_root(rootnode.nodeid.to_string(), rootnode.nodeid.NamespaceIndex)
+        self.cache.commit()
+        total_processed = 0
+        while True:
+            batch = self.cache.pending(self.max_nodes_per_browse * self.max_concurrent_browses)
+            if not batch:
+                break
+            children_results = await self.browse_wave([node_id for node_id, _ in batch])
+            for (node_id, depth), children in zip(batch, children_results):
+                self.cache.set_children(node_id, depth, children)
+            self.cache.commit()
+            total_processed += len(batch)
 
             elapsed_time = time.time() - self.start_time
             nodes_per_second = total_processed / elapsed_time if elapsed_time > 0 else 0
-            message = f"Nodes browsed: {total_processed}, Queue size: {self.node_queue.qsize()}, Speed: {nodes_per_second:.2f} nodes/s"
-            if self.print_callback:
-                self.print_callback(message)
+            self.report(f"Nodes browsed: {total_processed}, Queue size: {self.cache.pending_count()}, Speed: {nodes_per_second:.2f} nodes/s")
 
-        final_message = f"Total nodes browsed: {total_processed}"
-        if self.print_callback:
-            self.print_callback(final_message)
-        self.nodes = list(processed_nodes)
+        self.report(f"Total nodes browsed: {total_processed}, cached: {self.cache.count()}")
 
-    async def node_to_csv(self, node):
+    async def verify_cache(self, max_depth=None):
+        # Compares the children of cached branch nodes with the server and queues subtrees that
+        # changed to be browsed again. Leaf nodes are not checked.
+        branches = self.cache.branches(max_depth)
+        changed = 0
+        wave_size = self.max_nodes_per_browse * self.max_concurrent_browses
+        for i in range(0, len(branches), wave_size):
+            batch = [(node_id, digest) for node_id, digest in branches[i:i + wave_size] if self.cache.exists(node_id)]
+            children_results = await self.browse_wave([node_id for node_id, _ in batch])
+            for (node_id, digest), children in zip(batch, children_results):
+                if children_digest([child_id for child_id, _ in children]) != digest:
+                    self.cache.invalidate(node_id)
+                    changed += 1
+            self.cache.commit()
+            self.report(f"Nodes verified: {min(i + wave_size, len(branches))}/{len(branches)}, changed subtrees: {changed}")
+        return changed
+
+    async def read_operation_limit(self, object_id, default):
+        # One of the server's operation limits; 0 or missing means no limit was announced.
         try:
-            browse_name = await node.read_browse_name()
-            display_name = await node.read_display_name()
-            node_class = await node.read_node_class()
-            description = await node.read_description()
-            data_type = None
-            if node_class == ua.NodeClass.Variable:
-                data_type = await node.read_data_type()
-                data_type = str(data_type)
-            parent = await node.get_parent()
-            parent_id = parent.nodeid.to_string() if parent else None
-            return [
-                node.nodeid.to_string(),
-                browse_name.to_string(),
+            limit = await self.client.get_node(object_id).read_value()
+        except Exception:
+            limit = 0
+        return limit or default
+
+    async def read_rows(self, nodes):
+        # One Read request for all export attributes of the given (node_id, parent_id) pairs.
+        # The parent is the node the browse found this one under, so no extra request is needed.
+        params = ua.ReadParameters()
+        for node_id, _ in nodes:
+            nodeid = ua.NodeId.from_string(node_id)
+            params.NodesToRead.extend(ua.ReadValueId(NodeId=nodeid, AttributeId=attribute) for attribute in EXPORT_ATTRIBUTES)
+        results = await self.client.uaclient.read(params)
+        rows = []
+        for i, (node_id, parent_id) in enumerate(nodes):
+            browse_name, display_name, node_class, description, data_type = results[i * len(EXPORT_ATTRIBUTES):(i + 1) * len(EXPORT_ATTRIBUTES)]
+            if not browse_name.StatusCode.is_good():
+                logging.error(f"Error processing node {node_id}: {browse_name.StatusCode.name}")
+                rows.append(None)
+                continue
+            data_type_name = None
+            if node_class.Value.Value == ua.NodeClass.Variable and data_type.StatusCode.is_good():
+                data_type_id = data_type.Value.Value
+                # Built-in types by name (Float, Int32, ...), others by NodeId.
+                data_type_name = ua.ObjectIdNames.get(data_type_id.Identifier, data_type_id.to_string()) if data_type_id.NamespaceIndex == 0 else data_type_id.to_string()
+            rows.append([
+                node_id,
+                browse_name.Value.Value.to_string(),
                 parent_id,
-                data_type,
-                display_name.Text,
-                description.Text if description else None
-            ]
-        except Exception as e:
-            logging.error(f"Error processing node {node.nodeid}: {e}")
-            return None
+                data_type_name,
+                display_name.Value.Value.Text if display_name.StatusCode.is_good() else None,
+                description.Value.Value.Text if description.StatusCode.is_good() and description.Value.Value else None
+            ])
+        return rows
 
-    async def export_csv(self):
-        all_nodes = self.nodes
-        nodes = [node for node in all_nodes if node.nodeid.NamespaceIndex == self.namespace_filter]
-        total_nodes = len(nodes)
-        filtered_out = len(all_nodes) - total_nodes
+    async def row_batches(self, chunk_size):
+        # Yields the export rows page by page in browse order. Rows missing from the cache are
+        # read from the server (up to MAX_CONCURRENT_READS requests at a time) and cached first.
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_READS)
 
-        async def process_node(node):
-            try:
-                return await self.node_to_csv(node)
-            except Exception as e:
-                logging.error(f"Failed to export node {node.nodeid}: {e}")
-                return None
+        async def process_chunk(chunk):
+            async with semaphore:
+                try:
+                    return await self.read_rows(chunk)
+                except Exception as e:
+                    logging.error(f"Failed to export {len(chunk)} nodes starting at {chunk[0][0]}: {e}")
+                    return [None] * len(chunk)
 
-        batch_size = 1000
-        data = []
+        after_rowid = 0
+        while True:
+            page = self.cache.page(self.namespace_filter, after_rowid, chunk_size * MAX_CONCURRENT_READS)
+            if not page:
+                break
+            after_rowid = page[-1][0]
+            missing = [(node_id, parent_id) for _, node_id, parent_id, csv_row in page if csv_row is None]
+            results = await asyncio.gather(*[process_chunk(missing[j:j + chunk_size]) for j in range(0, len(missing), chunk_size)])
+            read = {}
+            for (node_id, _), row in zip(missing, [row for rows in results for row in rows]):
+                if row:
+                    self.cache.set_row(node_id, row)
+                    read[node_id] = row
+            self.cache.commit()
+            rows = []
+            for _, node_id, _, csv_row in page:
+                row = json.loads(csv_row) if csv_row is not None else read.get(node_id)
+                if row:
+                    rows.append(row)
+            yield len(missing), rows
+
+    async def export_csv(self):
+        # Streams the rows into the output files; only nodes without a cached row are read from the server.
+        total_nodes = self.cache.count(self.namespace_filter)
+        filtered_out = self.cache.count() - total_nodes
+        unexported = self.cache.unexported_count(self.namespace_filter)
+        outputs = [self.output_file] + ([self.nodes_file] if self.nodes_file else [])
+        if not unexported and self.cache.get_meta("dirty") == "0" and all(os.path.exists(path) for path in outputs):
+            self.report(f"Address space unchanged, keeping {', '.join(outputs)}")
+            return
+
+        # Each node needs len(EXPORT_ATTRIBUTES) ReadValueIds, which count against the operation limit.
+        chunk_size = max(1, await self.read_operation_limit(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerRead, DEFAULT_MAX_NODES_PER_READ) // len(EXPORT_ATTRIBUTES))
         start_time = time.time()
         processed = 0
+        exported = 0
 
-        for i in range(0, len(nodes), batch_size):
-            batch = nodes[i:i+batch_size]
-            results = await asyncio.gather(*[process_node(node) for node in batch])
-            data.extend([r for r in results if r])
-            processed += len(batch)
-            
-            elapsed_time = time.time() - start_time
-            nodes_per_second = processed / elapsed_time if elapsed_time > 0 else 0
-            
-            message = f"Nodes exported: {processed}/{total_nodes}, Speed: {nodes_per_second:.2f} nodes/s"
-            if self.print_callback:
-                self.print_callback(message)
-
-        df = pd.DataFrame(data, columns=["NodeId", "BrowseName", "ParentNodeId", "DataType", "DisplayName", "Description"])
-        df.to_csv(self.output_file, index=False)
-
-        final_message = f"Export completed. Total nodes: {len(all_nodes)}, Filtered out: {filtered_out}, Exported: {total_nodes}"
-        if self.print_callback:
-            self.print_callback(final_message)
+        # Write to temporary files and swap them in at the end, so readers never see a partial export.
+        with contextlib.ExitStack() as files:
+            output_writer = csv.writer(files.enter_context(open(self.output_file + ".tmp", "w", newline="")))
+            output_writer.writerow(OUTPUT_COLUMNS)
+            nodes_writer = None
+            if self.nodes_file:
+                nodes_writer = csv.writer(files.enter_context(open(self.nodes_file + ".tmp", "w", newline="")))
+                nodes_writer.writerow(NODES_COLUMNS)
+            async for read, rows in self.row_batches(chunk_size):
+                output_writer.writerows(rows)
+                if nodes_writer:
+                    nodes_writer.writerows([display_name, node_id, data_type] for node_id, _, _, data_type, display_name, _ in rows)
+                exported += len(rows)
+                if read:
+                    processed += read
+                    elapsed_time = time.time() - start_time
+                    nodes_per_second = processed / elapsed_time if elapsed_time > 0 else 0
+                    self.report(f"Nodes exported: {processed}/{unexported}, Speed: {nodes_per_second:.2f} nodes/s")
+        for path in outputs:
+            os.replace(path + ".tmp", path)
+        self.cache.set_meta("dirty", "0")
+        self.cache.commit()
+
+        self.report(f"Export completed. Total nodes: {total_nodes + filtered_out}, Filtered out: {filtered_out}, Exported: {exported}, Read from server: {processed}")
 
     async def import_nodes(self):
-        self.client = Client(self.server_url)
+        self.client = Client(self.server_url, timeout=REQUEST_TIMEOUT, watchdog_intervall=REQUEST_TIMEOUT)
         await self.client.connect()
         message = "Connected to OPC UA server\nBrowsing nodes..."
         if self.print_callback:
@@ -126,7 +348,48 @@ class NodeCSVExporter:
         else:
             print(message)
         root = self.client.get_root_node()
-        await self.start_node_browse(root)
+        # The cache belongs to one server and its namespace array; anything else starts over.
+        identity = json.dumps({"server_url": self.server_url, "namespaces": await self.client.get_namespace_array()})
+        server_start_time = str(await self.client.get_node(ua.ObjectIds.Server_ServerStatus_StartTime).read_value())
+        reset = self.cache.get_meta("identity") != identity
+        if reset:
+            self.cache.reset(identity)
+            self.cache.set_meta("server_start_time", server_start_time)
+            self.report("Node cache is empty or belongs to another server, browsing the whole address space")
+        await self.connect_browse_sessions()
+        try:
+            if not reset:
+                pending = self.cache.pending_count()
+                if pending:
+                    self.report(f"Resuming interrupted browse with {pending} queued nodes")
+                if self.cache.get_meta("server_start_time") != server_start_time:
+                    # The server restarted and may have loaded a different address space.
+                    self.report("Server restarted since the last browse, verifying cached nodes")
+                    await self.verify_cache()
+                    self.cache.mark_unexported()
+                elif not pending:
+                    await self.verify_cache(VERIFY_DEPTH)
+            await self.start_node_browse(root)
+        finally:
+            await self.disconnect_browse_sessions()
+        self.cache.set_meta("server_start_time", server_start_time)
+        self.cache.commit()
+
+    async def connect_browse_sessions(self):
+        self.max_nodes_per_browse = await self.read_operation_limit(ua.ObjectIds.Server_ServerCapabilities_OperationLimits_MaxNodesPerBrowse, DEFAULT_MAX_NODES_PER_BROWSE)
+        self.browse_clients = [self.client]
+        for _ in range(self.browse_sessions - 1):
+            client = Client(self.server_url, timeout=REQUEST_TIMEOUT, watchdog_intervall=REQUEST_TIMEOUT)
+            await client.connect()
+            self.browse_clients.append(client)
+
+    async def disconnect_browse_sessions(self):
+        for client in self.browse_clients[1:]:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logging.error(f"Error closing browse session: {e}")
+        self.browse_clients = []
 
 async def main():
     logging.basicConfig(level=logging.WARNING)
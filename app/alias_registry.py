@@ -0,0 +1,82 @@
+import json
+import os
+
+# Compact integer aliases for selected nodes, so batched payloads carry a small number instead of
+# the NodeId and the MQTT to InfluxDB converter resolves it with a list lookup.
+# The app owns the registry: it assigns aliases when the selection changes, saves the registry to
+# a file the OPC UA to MQTT converter reads, and publishes it retained for the other consumers.
+# Aliases are never reused. Nodes keep their alias after being deselected, so samples spooled
+# under an older version still resolve. The version goes up whenever an entry is added or changed.
+COLUMNS = ("NodeId", "Name", "DisplayName", "DataType", "Series")
+NODE_ID, NAME, DISPLAY_NAME, DATA_TYPE, SERIES = range(len(COLUMNS))
+
+def short_name(node_id):
+    # The sensor name samples are published and stored under.
+    return node_id.replace("ns=2;s=DB15.", "")
+
+class AliasRegistry:
+    def __init__(self, version=0, entries=()):
+        self.version = version
+        # entries[alias] is a tuple of COLUMNS.
+        self.entries = [tuple(entry) for entry in entries]
+        self.aliases = {entry[NODE_ID]: alias for alias, entry in enumerate(self.entries)}
+        self.names = [entry[NAME] for entry in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def alias(self, node_id):
+        return self.aliases.get(node_id)
+
+    def update(self, rows, series_key):
+        # rows: selected.csv rows; series_key(name) gives the InfluxDB series of a sensor name.
+        # Returns True if the registry changed.
+        changed = False
+        for row in rows:
+            node_id = row['NodeId']
+            name = short_name(node_id)
+            entry = (node_id, name, row.get('DisplayName') or "", row.get('DataType') or "", series_key(name))
+            alias = self.aliases.get(node_id)
+            if alias is None:
+                self.aliases[node_id] = len(self.entries)
+                self.entries.append(entry)
+                self.names.append(name)
+            elif self.entries[alias] != entry:
+                self.entries[alias] = entry
+            else:
+                continue
+            changed = True
+        if changed:
+            self.version += 1
+        return changed
+
+    def resolve(self, samples):
+        # Replaces aliases in decoded samples with sensor names; unknown aliases are left as they are.
+        names = self.names
+        return [(names[key] if key.__class__ is int and key < len(names) else key, *rest) for key, *rest in samples]
+
+    def series_keys(self):
+        return [entry[SERIES] for entry in self.entries]
+
+    def dumps(self):
+        return json.dumps({"version": self.version, "columns": COLUMNS, "nodes": self.entries}, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, text):
+        document = json.loads(text)
+        columns = [document["columns"].index(column) for column in COLUMNS]
+        return cls(document["version"], ([entry[column] for column in columns] for entry in document["nodes"]))
+
+    def save(self, path):
+        # Replaced in one step, so readers never see a half-written registry.
+        with open(path + ".tmp", 'w') as file:
+            file.write(self.dumps())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        # An empty registry if the file does not exist yet.
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as file:
+            return cls.loads(file.read())
@@ -0,0 +1,73 @@
+import json
+import os
+
+# Report-by-exception between the OPC UA read and the MQTT publish. A sample is published when
+# its status changes, when its value moved by more than the deadband since the last published
+# value, or when nothing was published for the node for heartbeat seconds.
+# A deadband is written "0.5" (absolute) or "2%" (percent of the last published value); "0"
+# publishes every change, an empty deadband disables the filter. Non-numeric values are
+# published whenever they change.
+# Settings come from the optional Deadband and Heartbeat columns of selected.csv, then from
+# COV_DATATYPE_DEFAULTS by the row's DataType, e.g. {"Double": {"Deadband": "0.5%", "Heartbeat": 300}},
+# then from COV_DEADBAND and COV_HEARTBEAT.
+
+class ChangeFilter:
+    __slots__ = ("deadband", "percent", "heartbeat", "last_value", "last_status", "last_time")
+
+    def __init__(self, deadband, percent=False, heartbeat=0):
+        self.deadband = deadband
+        self.percent = percent
+        self.heartbeat = heartbeat
+        self.last_value = None
+        self.last_status = None
+        self.last_time = None
+
+    def settings(self):
+        return (self.deadband, self.percent, self.heartbeat)
+
+    def passes(self, value, status, now):
+        # now is time.monotonic(); returns True if the sample should be published.
+        if self.last_time is None or status != self.last_status or self.heartbeat_due(now) or self._moved(value):
+            self.last_value = value
+            self.last_status = status
+            self.last_time = now
+            return True
+        return False
+
+    def heartbeat_due(self, now):
+        return bool(self.heartbeat) and self.last_time is not None and now - self.last_time >= self.heartbeat
+
+    def _moved(self, value):
+        last = self.last_value
+        if not _is_number(value) or not _is_number(last):
+            return value != last
+        limit = abs(last) * self.deadband / 100 if self.percent else self.deadband
+        return abs(value - last) > limit
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def load_defaults():
+    defaults = json.loads(os.environ.get('COV_DATATYPE_DEFAULTS') or '{}')
+    defaults[None] = {"Deadband": os.environ.get('COV_DEADBAND', ''), "Heartbeat": os.environ.get('COV_HEARTBEAT', '')}
+    return defaults
+
+def make_filter(row, defaults):
+    # Returns the ChangeFilter for a selected.csv row, or None to publish every sample.
+    # Raises ValueError for settings that do not parse.
+    deadband = _setting(row, defaults, "Deadband").strip()
+    if not deadband:
+        return None
+    heartbeat = float(_setting(row, defaults, "Heartbeat") or 0)
+    if deadband.endswith('%'):
+        return ChangeFilter(float(deadband[:-1]), True, heartbeat)
+    return ChangeFilter(float(deadband), False, heartbeat)
+
+def _setting(row, defaults, key):
+    # A non-empty column wins; a DataType default applies even when empty, so a type can opt out.
+    if row.get(key):
+        return str(row[key])
+    data_type = defaults.get(row.get('DataType'), {})
+    if key in data_type:
+        return str(data_type[key] if data_type[key] is not None else '')
+    return str(defaults[None].get(key) or '')
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from asyncua import Client, ua
+
+# Long-lived broker and server connections shared by all requests. Each keeps its connectivity
+# status up to date in the background, so health checks answer from memory instead of opening a
+# connection per request.
+OPCUA_CHECK_INTERVAL = 10
+OPCUA_TIMEOUT = 5
+
+class MqttConnection:
+    # One paho client for everything the app publishes and subscribes to. paho's network thread
+    # connects in the background and reconnects after broker restarts; subscriptions are renewed
+    # on every connect.
+    def __init__(self, host, port, keepalive=60):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.subscriptions = {}
+        self.retained = {}
+        self.lock = threading.Lock()
+        # None until the first connection attempt has finished.
+        self.connected = None
+        self.since = time.time()
+        self.error = None
+        self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_disconnect = self._on_disconnect
+
+    def start(self):
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def subscribe(self, topic, callback):
+        # callback(client, userdata, msg) runs on the network thread.
+        with self.lock:
+            self.subscriptions[topic] = callback
+            self.client.message_callback_add(topic, callback)
+            if self.connected:
+                self.client.subscribe(topic)
+
+    def publish(self, topic, payload, qos=0):
+        # Queued by paho while disconnected and sent once the connection is back.
+        return self.client.publish(topic, payload, qos=qos)
+
+    def publish_retained(self, topic, payload):
+        # Published again on every connect, in case the broker lost its retained messages.
+        # Returns the MQTTMessageInfo, or None while disconnected.
+        with self.lock:
+            self.retained[topic] = payload
+            if self.connected:
+                return self.client.publish(topic, payload, qos=1, retain=True)
+        return None
+
+    def status(self):
+        return {"connected": self.connected, "since": round(self.since, 3), "error": self.error, "broker": f"{self.host}:{self.port}"}
+
+    def _set(self, connected, error):
+        if connected != self.connected:
+            self.since = time.time()
+            if connected:
+                logging.info(f"MQTT connected to {self.host}:{self.port}")
+            else:
+                logging.error(f"MQTT connection to {self.host}:{self.port} unavailable: {error}")
+        self.connected = connected
+        self.error = error
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            self._set(False, mqtt.connack_string(rc))
+            return
+        with self.lock:
+            self._set(True, None)
+            for topic in self.subscriptions:
+                client.subscribe(topic)
+            for topic, payload in self.retained.items():
+                client.publish(topic, payload, qos=1, retain=True)
+
+    def _on_connect_fail(self, client, userdata):
+        self._set(False, "connection failed")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._set(False, mqtt.error_string(rc) if rc else "disconnected")
+
+class OpcUaConnection:
+    # A session to the OPC UA server that is kept open and probed every interval by reading the
+    # server state. A failed probe drops the session and the next check connects again.
+    def __init__(self, url, interval=OPCUA_CHECK_INTERVAL, timeout=OPCUA_TIMEOUT):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.client = None
+        self.task = None
+        # None until the first connection attempt has finished.
+        self.connected = None
+        self.since = time.time()
+        self.checked = None
+        self.state = None
+        self.error = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self._close()
+
+    async def run(self):
+        while True:
+            try:
+                if self.client is None:
+                    # A failed connect cleans up after itself; only a connected client is kept,
+                    # so _close does not disconnect (and warn about) a session that never opened.
+                    client = Client(self.url, timeout=self.timeout)
+                    await client.connect()
+                    self.client = client
+                # Bounded here too: while asyncua reconnects on its own, requests wait for it.
+                state = await asyncio.wait_for(self.client.nodes.server_state.read_value(), self.timeout)
+                self._set(True, None, ua.ServerState(state).name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._set(False, str(e) or type(e).__name__, None)
+                await self._close()
+            await asyncio.sleep(self.interval)
+
+    def status(self):
+        return {"connected": self.connected, "since": round(self.since, 3), "checked": self.checked and round(self.checked, 3),
+                "state": self.state, "error": self.error, "server": self.url}
+
+    def _set(self, connected, error, state):
+        if connected != self.connected:
+            self.since = time.time()
+            if connected:
+                logging.info(f"OPC UA connected to {self.url}")
+            else:
+                logging.error(f"OPC UA connection to {self.url} unavailable: {error}")
+        self.connected = connected
+        self.error = error
+        self.state = state
+        self.checked = time.time()
+
+    async def _close(self):
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
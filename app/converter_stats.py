@@ -0,0 +1,40 @@
+import json
+from bisect import bisect_left
+
+# Converters report counters to the app by printing a single prefixed JSON line on stdout.
+# The supervisor in main.py strips these lines from the logs and keeps the latest values.
+# "samples" is a running total of samples handled and is used to derive throughput.
+# Histograms are reported under "histograms" and rendered by /metrics.
+STATS_PREFIX = "@@stats "
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+BATCH_BUCKETS = (1, 10, 100, 500, 1000, 2500, 5000, 10000, 50000)
+
+def report_stats(**stats):
+    print(STATS_PREFIX + json.dumps(stats, separators=(',', ':')), flush=True)
+
+def parse_stats(line):
+    # Returns the stats dict for a stats line, otherwise None.
+    if not line.startswith(STATS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(STATS_PREFIX):])
+    except ValueError:
+        return None
+
+class Histogram:
+    # Counts since the process started; counts[i] holds observations <= buckets[i], the last
+    # count the ones above every bucket. Not thread-safe, observe from one thread only.
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {"buckets": self.buckets, "counts": list(self.counts), "sum": round(self.sum, 6), "count": self.count}
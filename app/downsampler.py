@@ -0,0 +1,235 @@
+import threading
+import time
+
+import numpy as np
+
+# Windowed aggregates (min, max, mean, last, count) of every series, computed for all series at
+# once with NumPy. Samples are buffered per series in ring buffers, the rows of 2-D arrays; when
+# the shortest window closes, its samples are aggregated with one pass over the arrays, and the
+# longer windows are rolled up from those aggregates.
+# Windows are aligned to the epoch, and each one must be a multiple of the shortest. Samples go to
+# the window of their source timestamp. Samples stamped before the oldest open window (replayed from
+# a spool, or arriving more than delay late) belong to windows already written; they are counted as
+# late and left out rather than skewing the open window.
+# Open windows are not written at shutdown, so a restart never overwrites a complete aggregate with
+# a partial one.
+INITIAL_ROWS = 1024
+INITIAL_CAPACITY = 16
+STATS_INTERVAL = 10
+
+def parse_windows(text):
+    # "1,10,60" -> [1, 10, 60] (seconds); raises ValueError for windows that do not nest.
+    windows = sorted({int(window) for window in text.split(',') if window.strip()})
+    if not windows or windows[0] <= 0:
+        raise ValueError(f"invalid windows: {text!r}")
+    if any(window % windows[0] for window in windows):
+        raise ValueError(f"windows must be multiples of {windows[0]} s: {text!r}")
+    return windows
+
+def window_label(seconds):
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+class _Window:
+    # Running aggregates of one window length, one row per series.
+    def __init__(self, seconds, rows):
+        self.seconds = seconds
+        self.ms = seconds * 1000
+        self.label = window_label(seconds)
+        self.prefixes = []
+        self.min = np.full(rows, np.inf)
+        self.max = np.full(rows, -np.inf)
+        self.sum = np.zeros(rows)
+        self.count = np.zeros(rows, np.int64)
+        self.last = np.zeros(rows)
+        self.last_time = np.full(rows, np.iinfo(np.int64).min)
+
+    def grow(self, rows):
+        extra = rows - len(self.count)
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+        self.sum = np.concatenate([self.sum, np.zeros(extra)])
+        self.count = np.concatenate([self.count, np.zeros(extra, np.int64)])
+        self.last = np.concatenate([self.last, np.zeros(extra)])
+        self.last_time = np.concatenate([self.last_time, np.full(extra, np.iinfo(np.int64).min)])
+
+    def merge(self, n, vmin, vmax, vsum, count, last, last_time):
+        np.minimum(self.min[:n], vmin, out=self.min[:n])
+        np.maximum(self.max[:n], vmax, out=self.max[:n])
+        self.sum[:n] += vsum
+        self.count[:n] += count
+        newer = (count > 0) & (last_time >= self.last_time[:n])
+        self.last[:n] = np.where(newer, last, self.last[:n])
+        self.last_time[:n] = np.where(newer, last_time, self.last_time[:n])
+
+    def take(self, n):
+        # Returns (rows, min, max, mean, last, count) of the series with samples, as lists, and resets.
+        rows = np.flatnonzero(self.count[:n])
+        result = (rows.tolist(), self.min[rows].tolist(), self.max[rows].tolist(), (self.sum[rows] / self.count[rows]).tolist(),
+                  self.last[rows].tolist(), self.count[rows].tolist())
+        self.min[rows] = np.inf
+        self.max[rows] = -np.inf
+        self.sum[rows] = 0
+        self.count[rows] = 0
+        self.last_time[rows] = np.iinfo(np.int64).min
+        return result
+
+class Downsampler:
+    # add() is called from the MQTT thread; everything else runs on the downsampler's own thread.
+    # emit(line) receives the aggregate lines; aggregate_prefix(series, suffix) turns a series'
+    # line prefix into the prefix of its aggregate series, for a measurement suffix such as "_10s".
+    def __init__(self, windows, emit, aggregate_prefix, delay=2.0):
+        self.emit = emit
+        self.aggregate_prefix = aggregate_prefix
+        self.delay_ms = int(delay * 1000)
+        self.lock = threading.Lock()
+        self.staged = ([], [], [])
+        self.slots = {}
+        self.windows = [_Window(seconds, INITIAL_ROWS) for seconds in windows]
+        self.base_ms = self.windows[0].ms
+        self.capacity = INITIAL_CAPACITY
+        self.values = np.zeros((INITIAL_ROWS, self.capacity))
+        self.times = np.zeros((INITIAL_ROWS, self.capacity), np.int64)
+        self.head = np.zeros(INITIAL_ROWS, np.int64)
+        self.size = np.zeros(INITIAL_ROWS, np.int64)
+        self.open_end = None
+        self.samples = 0
+        self.late = 0
+        self.points = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="downsampler", daemon=True)
+
+    def start(self):
+        self.open_end = (int(time.time() * 1000) // self.base_ms + 1) * self.base_ms
+        self.thread.start()
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def add(self, series, values, timestamps):
+        # Parallel lists: each sample's series (its line prefix), value and timestamp in ms.
+        with self.lock:
+            self.staged[0].extend(series)
+            self.staged[1].extend(values)
+            self.staged[2].extend(timestamps)
+
+    def describe(self):
+        return (f"{len(self.slots)} series, {self.samples} samples, {self.late} late, {self.points} aggregate points "
+                f"({', '.join(window.label for window in self.windows)}), buffer capacity: {self.capacity}")
+
+    def _run(self):
+        last_stats = time.monotonic()
+        while not self.stopping.wait(min(1.0, self.base_ms / 1000 / 2)):
+            self._drain()
+            now = int(time.time() * 1000)
+            while self.open_end + self.delay_ms <= now:
+                if not self.size.any() and not any(window.count.any() for window in self.windows):
+                    # Nothing buffered; skip straight to the window that is due last.
+                    self.open_end = max(self.open_end, (now - self.delay_ms) // self.base_ms * self.base_ms)
+                self._close(self.open_end)
+                self.open_end += self.base_ms
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                print(f"Downsampler: {self.describe()}")
+
+    def _slot(self, series):
+        slot = self.slots[series] = len(self.slots)
+        if slot == len(self.size):
+            rows = 2 * len(self.size)
+            self.values = np.concatenate([self.values, np.zeros((rows - slot, self.capacity))])
+            self.times = np.concatenate([self.times, np.zeros((rows - slot, self.capacity), np.int64)])
+            self.head = np.concatenate([self.head, np.zeros(rows - slot, np.int64)])
+            self.size = np.concatenate([self.size, np.zeros(rows - slot, np.int64)])
+            for window in self.windows:
+                window.grow(rows)
+        for window in self.windows:
+            window.prefixes.append(self.aggregate_prefix(series, f"_{window.label}"))
+        return slot
+
+    def _drain(self):
+        with self.lock:
+            series, values, timestamps = self.staged
+            self.staged = ([], [], [])
+        if not series:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        times = np.asarray(timestamps, dtype=np.int64)
+        current = times >= self.open_end - self.base_ms
+        if not current.all():
+            self.late += len(times) - int(current.sum())
+            series = [key for key, keep in zip(series, current.tolist()) if keep]
+            values = values[current]
+            times = times[current]
+            if not series:
+                return
+        slots_of = self.slots
+        slots = np.fromiter((slots_of[key] if key in slots_of else self._slot(key) for key in series), np.int64, len(series))
+        # Position of each sample within its series, in arrival order.
+        order = np.argsort(slots, kind='stable')
+        slots = slots[order]
+        unique, starts, counts = np.unique(slots, return_index=True, return_counts=True)
+        rank = np.arange(len(slots)) - np.repeat(starts, counts)
+        needed = int((self.size[unique] + counts).max())
+        if needed > self.capacity:
+            self._grow(needed)
+        positions = (self.head[slots] + self.size[slots] + rank) % self.capacity
+        self.values[slots, positions] = values[order]
+        self.times[slots, positions] = times[order]
+        self.size[unique] += counts
+        self.samples += len(slots)
+
+    def _ordered(self, n):
+        # The buffered samples of the first n series, oldest first: (values, times, valid mask).
+        offsets = np.arange(self.capacity)
+        index = (self.head[:n, None] + offsets) % self.capacity
+        return (np.take_along_axis(self.values[:n], index, 1), np.take_along_axis(self.times[:n], index, 1),
+                offsets < self.size[:n, None])
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        values, times, _ = self._ordered(len(self.size))
+        self.values = np.zeros((len(self.size), capacity))
+        self.times = np.zeros((len(self.size), capacity), np.int64)
+        self.values[:, :self.capacity] = values
+        self.times[:, :self.capacity] = times
+        self.head[:] = 0
+        self.capacity = capacity
+
+    def _close(self, end):
+        # Aggregates the samples stamped before end, rolls them into every window and writes the
+        # windows that end here.
+        n = len(self.slots)
+        values, times, valid = self._ordered(n)
+        inside = valid & (times < end)
+        count = inside.sum(1)
+        last_position = np.where(inside, times, np.iinfo(np.int64).min).argmax(1)
+        rows = np.arange(n)
+        aggregates = (np.where(inside, values, np.inf).min(1), np.where(inside, values, -np.inf).max(1),
+                      np.where(inside, values, 0.0).sum(1), count, values[rows, last_position], times[rows, last_position])
+        if (inside == (valid & (np.arange(self.capacity) < count[:, None]))).all():
+            # The usual case: the aggregated samples are the oldest ones of each series.
+            self.head[:n] = (self.head[:n] + count) % self.capacity
+        else:
+            # Samples arrived out of order; keep the rest, compacted to the front of each row.
+            keep = valid & ~inside
+            order = np.argsort(~keep, axis=1, kind='stable')
+            self.values[:n] = np.take_along_axis(values, order, 1)
+            self.times[:n] = np.take_along_axis(times, order, 1)
+            self.head[:n] = 0
+        self.size[:n] -= count
+        for window in self.windows:
+            window.merge(n, *aggregates)
+            if end % window.ms == 0:
+                self._emit(window, end - window.ms)
+
+    def _emit(self, window, start):
+        prefixes = window.prefixes
+        for row, vmin, vmax, mean, last, count in zip(*window.take(len(self.slots))):
+            self.emit(b"%smin=%r,max=%r,mean=%r,last=%r,count=%di %d" % (prefixes[row], vmin, vmax, mean, last, count, start))
+            self.points += 1
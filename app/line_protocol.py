@@ -0,0 +1,48 @@
+import math
+
+# Turns decoded samples straight into InfluxDB line protocol, skipping Point objects.
+# Lines use millisecond timestamps, so write them with WritePrecision.MS.
+
+def escape_measurement(name):
+    return name.replace("\\", "\\\\").replace(",", "\\,").replace(" ", "\\ ")
+
+def escape_tag(value):
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+class LineEncoder:
+    def __init__(self, measurement="sensor_data", tag="sensor"):
+        self.measurement = escape_measurement(measurement)
+        self.tag = escape_tag(tag)
+        self.prefixes = {}
+
+    def series_key(self, sensor_name):
+        # "<measurement>,<tag>=<sensor>", escaped; the alias registry carries these precomputed.
+        return f"{self.measurement},{self.tag}={escape_tag(str(sensor_name))}"
+
+    def series_prefix(self, series_key):
+        return f"{series_key} value=".encode()
+
+    def aggregate_prefix(self, prefix, suffix):
+        # "<measurement><suffix>,<tag>=<sensor> " for the downsampled series of a line prefix.
+        measurement = self.measurement.encode()
+        return b"%s%s%s " % (measurement, escape_measurement(suffix).encode(), prefix[len(measurement):-len(b" value=")])
+
+    def prefix(self, sensor_name):
+        # "<measurement>,<tag>=<sensor> value=" escaped once per sensor and cached by node_id.
+        prefix = self.prefixes.get(sensor_name)
+        if prefix is None:
+            prefix = self.prefixes[sensor_name] = self.series_prefix(self.series_key(sensor_name))
+        return prefix
+
+    def encode(self, sensor_name, value, timestamp=None, status=0):
+        # Returns one line as bytes, or None for values InfluxDB cannot store.
+        return self.encode_prefixed(self.prefixes.get(sensor_name) or self.prefix(sensor_name), value, timestamp, status)
+
+    def encode_prefixed(self, prefix, value, timestamp=None, status=0):
+        # As encode, with the prefix of the series already looked up.
+        value = float(value)
+        if not math.isfinite(value):
+            return None
+        if timestamp is None:
+            return b"%s%r" % (prefix, value)
+        return b"%s%r,status=%di %d" % (prefix, value, status, timestamp)
@@ -0,0 +1,28 @@
+import os
+import time
+
+# Per-message output (every published sample, every bad node) would cost more than the data path
+# itself at high rates, so such messages are printed at most once per LOG_SAMPLE_INTERVAL seconds
+# with a count of the ones skipped in between. LOG_SAMPLE_INTERVAL=0 prints everything.
+DEFAULT_LOG_SAMPLE_INTERVAL = 1.0
+
+class RateLimitedLog:
+    def __init__(self, interval=None):
+        self.interval = float(os.environ.get('LOG_SAMPLE_INTERVAL', DEFAULT_LOG_SAMPLE_INTERVAL)) if interval is None else interval
+        self.last = None
+        self.suppressed = 0
+
+    def due(self):
+        # Check before formatting the message, so skipped messages cost no more than this call.
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            self.suppressed += 1
+            return False
+        self.last = now
+        return True
+
+    def print(self, message):
+        if self.suppressed:
+            message = f"{message} (+{self.suppressed} similar messages not shown)"
+            self.suppressed = 0
+        print(message)
@@ -0,0 +1,52 @@
+import os
+
+# Incremental log reading for the logs page. Cost depends on how much is new, not on the size of
+# the file. A cursor is (inode, offset) of the first byte not yet sent; when the inode changes or the
+# file shrinks, the log was rotated or cleared and reading starts over at the beginning.
+TAIL_BLOCK_SIZE = 8192
+MAX_READ_BYTES = 256 * 1024
+
+def tail_lines(path, count):
+    # Returns the last count complete lines and a cursor after them, reading backwards from EOF.
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return [], (0, 0)
+    with file:
+        inode = os.fstat(file.fileno()).st_ino
+        end = position = file.seek(0, os.SEEK_END)
+        data = b""
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(TAIL_BLOCK_SIZE, position)
+            position -= step
+            file.seek(position)
+            data = file.read(step) + data
+    # A line still being written is left for the next read.
+    partial = len(data) - (data.rfind(b"\n") + 1)
+    data = data[:len(data) - partial]
+    lines = data.decode(errors='replace').splitlines(keepends=True)
+    if position > 0:
+        lines = lines[1:]
+    return lines[-count:], (inode, end - partial)
+
+def read_after(path, cursor):
+    # Returns the complete lines written since cursor (at most MAX_READ_BYTES) and the new cursor.
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return [], (0, 0)
+    inode, offset = cursor
+    if stat.st_ino != inode or stat.st_size < offset:
+        offset = 0
+    if stat.st_size == offset:
+        return [], (stat.st_ino, offset)
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(MAX_READ_BYTES)
+    end = data.rfind(b"\n") + 1
+    if end == 0:
+        if len(data) < MAX_READ_BYTES:
+            return [], (stat.st_ino, offset)
+        # One line longer than a whole read; send it in pieces.
+        end = len(data)
+    return data[:end].decode(errors='replace').splitlines(keepends=True), (stat.st_ino, offset + end)
@@ -1,21 +1,38 @@
-from fastapi import FastAPI, HTTPException, Request, Form, UploadFile, File
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request, Form, UploadFile, File, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
+from typing import List, Literal, Optional
 import csv
+import json
 import os
 import logging
+import logging.handlers
 import asyncio
-import paho.mqtt.client as mqtt
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from .NodeCsvExporter import NodeCSVExporter
+from .supervisor import Supervisor
+from .node_catalog import NodeCatalog
+from .log_tail import tail_lines, read_after
+from .value_cache import ValueCache
+from .metrics import render_metrics
+from .payload_codec import decode_samples
+from .connections import MqttConnection, OpcUaConnection
+from .alias_registry import AliasRegistry
+from .line_protocol import LineEncoder
 import tempfile
 from starlette.background import BackgroundTask
 
 LOG_FILE = "app/logs/application.log"
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 3))
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(handlers=[logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)],
+                    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# asyncua logs every connection attempt at INFO; OpcUaConnection logs when the server comes and goes.
+logging.getLogger("asyncua").setLevel(logging.WARNING)
 
 node_csv_exporter_running = False
 node_csv_exporter_progress = []
@@ -23,28 +40,197 @@ node_csv_exporter_progress = []
 app = FastAPI()
 templates = Jinja2Templates(directory="app/templates")
 
-OPCUA_SERVER_URL = "opc.tcp://100.94.111.58:4841"
+OPCUA_SERVER_URL = os.environ.get('OPCUA_SERVER_URL', "opc.tcp://100.94.111.58:4841")
+MQTT_BROKER = os.environ.get('MQTT_BROKER', "host.docker.internal")
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+MQTT_CONTROL_TOPIC = "opcua_to_mqtt/control"
+MQTT_DATA_TOPIC = "plant1/#"
+MQTT_ALIAS_TOPIC = "opcua_to_mqtt/aliases"
 
 NODES_CSV = "app/data/nodes.csv"
 SELECTED_CSV = "app/data/selected.csv"
 NODES_OUTPUT_CSV = "app/data/nodes_output.csv"
+NODE_CACHE_FILE = "app/data/node_cache.sqlite"
+NODE_CATALOG_FILE = "app/data/node_catalog.sqlite"
+ALIAS_FILE = "app/data/aliases.json"
+# OPC UA sessions used for the startup browse, and Browse requests kept in flight across them.
+BROWSE_SESSIONS = int(os.environ.get('BROWSE_SESSIONS', 1))
+BROWSE_CONCURRENCY = int(os.environ.get('BROWSE_CONCURRENCY', 4))
 
 OPCUA_TO_MQTT_LOG_FILE = "app/logs/opcua_to_mqtt.log"
 MQTT_TO_INFLUX_LOG_FILE = "app/logs/mqtt_to_influx.log"
+LOG_FILES = {"Application": LOG_FILE, "opcua_to_MQTT_Converter.py": OPCUA_TO_MQTT_LOG_FILE, "mqtt_to_Influx_Converter.py": MQTT_TO_INFLUX_LOG_FILE}
+LOG_TAIL_LINES = 100
+LOG_POLL_INTERVAL = 0.5
+LOG_KEEPALIVE_INTERVAL = 15
 OPCUA_TO_MQTT_SCRIPT = "app/opcua_to_MQTT_Converter.py"
 MQTT_TO_INFLUX_SCRIPT = "app/mqtt_to_Influx_Converter.py"
 
+# Number of OPC UA to MQTT processes the selection is split across (see SHARD_STRATEGY).
+OPCUA_SHARDS = int(os.environ.get('OPCUA_SHARDS', 1))
+
+supervisor = Supervisor(LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+opcua_to_mqtt = supervisor.add_sharded("opcua_to_mqtt", OPCUA_TO_MQTT_SCRIPT, OPCUA_TO_MQTT_LOG_FILE, OPCUA_SHARDS)
+mqtt_to_influx = supervisor.add("mqtt_to_influx", MQTT_TO_INFLUX_SCRIPT, MQTT_TO_INFLUX_LOG_FILE)
+
+node_catalog = NodeCatalog(NODE_CATALOG_FILE)
+# Selection deltas are written back to selected.csv at most once per this many seconds.
+SELECTION_WRITE_DELAY = 2
+selection_write_task = None
+# Set for every change; a change made while the write is running makes the task write again.
+selection_write_dirty = False
+selection_reload_pending = False
+
+# Compact aliases for the selected nodes, carried by batched payloads instead of the NodeId. Updated
+# whenever the selection is loaded or written, and published retained on MQTT_ALIAS_TOPIC.
+ALIAS_PUBLISH_TIMEOUT = 5
+try:
+    alias_registry = AliasRegistry.load(ALIAS_FILE)
+except Exception as e:
+    # Starting from an empty registry would hand out aliases again that spooled and retained
+    # samples still carry, and those would resolve to the wrong nodes.
+    logging.error(f"Error loading {ALIAS_FILE}, not starting: {e}. Restore the file, e.g. from the retained {MQTT_ALIAS_TOPIC} message.")
+    raise
+# Series keys as the MQTT to InfluxDB converter writes them.
+influx_series = LineEncoder("sensor_data", "sensor")
+
+# Current values of everything the OPC UA to MQTT converter publishes, for /values and /values/ws.
+VALUE_STREAM_INTERVAL = 0.5
+value_cache = ValueCache()
+
+# One MQTT connection for control messages and the value subscription, and one OPC UA session kept
+# open for health checks; /health and /test_mqtt report their cached status.
+mqtt_connection = MqttConnection(MQTT_BROKER, MQTT_PORT)
+opcua_connection = OpcUaConnection(OPCUA_SERVER_URL)
+
+# Blocking file, CSV and catalog work runs on this many threads instead of the event loop.
+IO_THREADS = int(os.environ.get('IO_THREADS', 4))
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+def read_file(path):
+    with open(path, 'r') as file:
+        return file.read()
+
+def write_file(path, contents):
+    with open(path, "wb") as file:
+        file.write(contents)
+
+def load_selection():
+    # At startup; the lifespan publishes the registry once the MQTT connection starts.
+    try:
+        with open(SELECTED_CSV, mode='r') as file:
+            node_catalog.set_selection(csv.DictReader(file))
+        update_aliases()
+    except Exception as e:
+        logging.error(f"Error loading {SELECTED_CSV}: {e}")
+
+def update_aliases():
+    # Assigns aliases to newly selected nodes and saves the registry. Returns the registry to
+    # publish, or None if nothing changed.
+    with node_catalog.lock:
+        if not alias_registry.update(node_catalog.selected_rows(), influx_series.series_key):
+            return None
+        alias_registry.save(ALIAS_FILE)
+        payload = alias_registry.dumps()
+    logging.info(f"Alias registry version {alias_registry.version}: {len(alias_registry)} aliases")
+    return payload
+
+def publish_aliases(payload):
+    # paho sends in order, so the broker keeps the newest version even with concurrent updates.
+    info = mqtt_connection.publish_retained(MQTT_ALIAS_TOPIC, payload)
+    if info is not None:
+        # Consumers should have the registry before samples with the new aliases reach them.
+        try:
+            info.wait_for_publish(ALIAS_PUBLISH_TIMEOUT)
+        except (ValueError, RuntimeError) as e:
+            # Published again when the connection is back.
+            logging.error(f"Error publishing alias registry: {e}")
+
+def write_selected_csv():
+    # Replace the file in one step so the converter never reads a half-written selection. New
+    # aliases are saved and published first, so the converters have them when the file changes.
+    # Runs in the background (see schedule_selected_csv_write), never holding the catalog lock
+    # while it waits for the broker.
+    payload = update_aliases()
+    if payload is not None:
+        publish_aliases(payload)
+    with node_catalog.lock:
+        fieldnames = ["DisplayName", "NodeId", "DataType"] + node_catalog.optional_columns()
+        with open(SELECTED_CSV + ".tmp", mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(node_catalog.selected_rows())
+        os.replace(SELECTED_CSV + ".tmp", SELECTED_CSV)
+
+async def write_selected_csv_later(delay):
+    global selection_write_dirty, selection_reload_pending
+    while selection_write_dirty:
+        await asyncio.sleep(delay)
+        selection_write_dirty = False
+        reload, selection_reload_pending = selection_reload_pending, False
+        try:
+            await run_blocking(write_selected_csv)
+        except Exception as e:
+            logging.error(f"Error writing {SELECTED_CSV}: {e}")
+            # The next change writes again and still owes the converter its reload.
+            selection_reload_pending = selection_reload_pending or reload
+            return
+        if reload and opcua_to_mqtt.reload():
+            logging.info("OPC UA to MQTT converter reloading new node selection")
+
+def schedule_selected_csv_write(delay=SELECTION_WRITE_DELAY, reload=False):
+    # Changes arriving while a write is pending are picked up by that write, and changes arriving
+    # while it runs by another one. With reload, the converter is told to reload right after the
+    # write instead of noticing the file change.
+    global selection_write_task, selection_write_dirty, selection_reload_pending
+    selection_write_dirty = True
+    selection_reload_pending = selection_reload_pending or reload
+    if selection_write_task is None or selection_write_task.done():
+        selection_write_task = asyncio.create_task(write_selected_csv_later(delay))
+
+def publish_control(command):
+    # The running converter applies selection deltas from its control topic. If it misses one,
+    # it still catches up when selected.csv is rewritten.
+    mqtt_connection.publish(MQTT_CONTROL_TOPIC, json.dumps(command), qos=1)
+
+def on_value_message(client, userdata, msg):
+    try:
+        value_cache.update(alias_registry.resolve(decode_samples(msg.payload)))
+    except Exception as e:
+        logging.error(f"Error decoding message on {msg.topic}: {e}")
 
-opcua_to_mqtt_process = None
-mqtt_to_influx_process = None
+def sync_node_catalog():
+    # nodes_output.csv carries BrowseName and ParentNodeId for search; nodes.csv is the fallback.
+    try:
+        if node_catalog.sync_csv(NODES_OUTPUT_CSV) or (not len(node_catalog) and node_catalog.sync_csv(NODES_CSV)):
+            logging.info(f"Node catalog loaded: {len(node_catalog)} nodes")
+    except Exception as e:
+        logging.error(f"Error loading node catalog: {e}")
 
 async def lifespan(app: FastAPI):
     # Startup
     logging.debug("Startup event called")
+    supervisor.recover()
+    await run_blocking(load_selection)
+    mqtt_connection.subscribe(MQTT_DATA_TOPIC, on_value_message)
+    if len(alias_registry):
+        mqtt_connection.publish_retained(MQTT_ALIAS_TOPIC, alias_registry.dumps())
+    mqtt_connection.start()
+    opcua_connection.start()
     asyncio.create_task(background_node_csv_export())
     yield
     # Shutdown
     logging.debug("Shutdown event called")
+    mqtt_connection.stop()
+    await opcua_connection.stop()
+    if selection_write_task and not selection_write_task.done():
+        selection_write_task.cancel()
+        write_selected_csv()
+    await supervisor.shutdown()
+    io_executor.shutdown()
 
 app = FastAPI(lifespan=lifespan)
     
@@ -54,7 +240,7 @@ async def background_node_csv_export():
     node_csv_exporter_running = True
     try:
         await run_node_csv_exporter()
-        create_nodes_csv_from_nodes_output()
+        await run_blocking(sync_node_catalog)
     finally:
         node_csv_exporter_running = False
 
@@ -68,7 +254,8 @@ async def run_node_csv_exporter():
         else:
             node_csv_exporter_progress.append(message)
     
-    exporter = NodeCSVExporter(server_url, NODES_OUTPUT_CSV, print_callback=print_callback)
+    exporter = NodeCSVExporter(server_url, NODES_OUTPUT_CSV, print_callback=print_callback, cache_file=NODE_CACHE_FILE, nodes_file=NODES_CSV,
+                               browse_sessions=BROWSE_SESSIONS, max_concurrent_browses=BROWSE_CONCURRENCY)
     try:
         await exporter.import_nodes()
         await exporter.export_csv()
@@ -80,25 +267,12 @@ async def run_node_csv_exporter():
             await exporter.client.disconnect()
             node_csv_exporter_progress.append("Disconnected from OPC UA server")
 
-def create_nodes_csv_from_nodes_output():
-    if not os.path.exists(NODES_OUTPUT_CSV):
-        logging.error(f"nodes_output.csv not found at {NODES_OUTPUT_CSV}")
-        return
-
-    with open(NODES_OUTPUT_CSV, mode='r') as input_file, open(NODES_CSV, mode='w', newline='') as output_file:
-        reader = csv.DictReader(input_file)
-        writer = csv.writer(output_file)
-        writer.writerow(["DisplayName", "NodeId", "DataType"])
-        for row in reader:
-            writer.writerow([row['DisplayName'], row['NodeId'], row['DataType']])
-    logging.info(f"Created {NODES_CSV} from {NODES_OUTPUT_CSV}")
-
 @app.post("/import_nodes_csv")
 async def import_nodes_csv(file: UploadFile = File(...)):
     try:
         contents = await file.read()
-        with open(NODES_CSV, "wb") as f:
-            f.write(contents)
+        await run_blocking(write_file, NODES_CSV, contents)
+        await run_blocking(node_catalog.load_csv, NODES_CSV)
         return {"message": "nodes.csv imported successfully"}
     except Exception as e:
         logging.error(f"Error importing nodes.csv: {e}")
@@ -108,13 +282,8 @@ async def import_nodes_csv(file: UploadFile = File(...)):
 async def import_selected_csv(file: UploadFile = File(...)):
     try:
         contents = await file.read()
-        with open(SELECTED_CSV, "wb") as f:
-            f.write(contents)
-        if is_process_running(OPCUA_TO_MQTT_SCRIPT):
-            stop_script(OPCUA_TO_MQTT_SCRIPT)
-            await asyncio.sleep(1)
-            await start_script(OPCUA_TO_MQTT_SCRIPT)
-            logging.info("OPC UA to MQTT converter restarted with new node selection")
+        await run_blocking(node_catalog.set_selection, csv.DictReader(contents.decode("utf-8-sig").splitlines()))
+        schedule_selected_csv_write(0, reload=True)
         return {"message": "selected.csv imported successfully"}
     except Exception as e:
         logging.error(f"Error importing selected.csv: {e}")
@@ -122,19 +291,21 @@ async def import_selected_csv(file: UploadFile = File(...)):
 
 @app.get("/export_nodes_csv")
 async def export_nodes_csv():
-    return FileResponse(NODES_CSV, filename="nodes.csv")
+    return StreamingResponse(node_catalog.dump_csv(), media_type="text/csv", headers={"Content-Disposition": 'attachment; filename="nodes.csv"'})
 
 @app.get("/export_selected_csv")
 async def export_selected_csv():
-    try:
+    def copy_selected_csv():
         # Ensure we're reading the most recent version of the file
-        with open(SELECTED_CSV, 'r') as file:
-            content = file.read()
-        
+        content = read_file(SELECTED_CSV)
+
         # Create a temporary file with the current content
         with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.csv') as temp_file:
             temp_file.write(content)
-            temp_path = temp_file.name
+            return temp_file.name
+
+    try:
+        temp_path = await run_blocking(copy_selected_csv)
 
         # Use the temporary file for the response
         return FileResponse(temp_path, filename="selected.csv", background=BackgroundTask(lambda: os.unlink(temp_path)))
@@ -152,8 +323,7 @@ async def debug_selected_csv():
             logging.error(f"File not found: {file_path}")
             raise HTTPException(status_code=404, detail="Selected CSV file not found")
         
-        with open(file_path, 'r') as file:
-            content = file.read()
+        content = await run_blocking(read_file, file_path)
         logging.info(f"File content (first 100 chars): {content[:100]}")
         return {"content": content}
     except Exception as e:
@@ -173,41 +343,11 @@ class IntervalUpdate(BaseModel):
 class ConverterToggle(BaseModel):
     turn_on: bool
 
-async def run_script(script_name):
-    global opcua_to_mqtt_process, mqtt_to_influx_process
-    log_file_path = OPCUA_TO_MQTT_LOG_FILE if script_name == OPCUA_TO_MQTT_SCRIPT else MQTT_TO_INFLUX_LOG_FILE
-    process = await asyncio.create_subprocess_exec('python3', script_name, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    if script_name == OPCUA_TO_MQTT_SCRIPT: opcua_to_mqtt_process = process
-    elif script_name == MQTT_TO_INFLUX_SCRIPT: mqtt_to_influx_process = process
-    while True:
-        line = await process.stdout.readline()
-        if not line: break
-        with open(log_file_path, 'a') as log_file:
-            log_file.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {script_name}: {line.decode().strip()}\n")
-    error = await process.stderr.read()
-    if error:
-        with open(log_file_path, 'a') as log_file:
-            log_file.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {script_name} Error: {error.decode().strip()}\n")
-    await process.wait()
-
-def is_process_running(script_name):
-    return (opcua_to_mqtt_process if script_name == OPCUA_TO_MQTT_SCRIPT else mqtt_to_influx_process) is not None and (opcua_to_mqtt_process if script_name == OPCUA_TO_MQTT_SCRIPT else mqtt_to_influx_process).returncode is None
-
-async def start_script(script_name):
-    if not is_process_running(script_name):
-        asyncio.create_task(run_script(script_name))
-        return True
-    return False
-
-def stop_script(script_name):
-    global opcua_to_mqtt_process, mqtt_to_influx_process
-    process = opcua_to_mqtt_process if script_name == OPCUA_TO_MQTT_SCRIPT else mqtt_to_influx_process
-    if process:
-        process.terminate()
-        if script_name == OPCUA_TO_MQTT_SCRIPT: opcua_to_mqtt_process = None
-        else: mqtt_to_influx_process = None
-        return True
-    return False
+class AcquisitionSettings(BaseModel):
+    mode: Literal["poll", "subscription"] = "poll"
+    publishing_interval: int = 1000
+    sampling_interval: int = 500
+    deadband: float = 0.0
 
 @app.get("/")
 async def home(request: Request):
@@ -215,8 +355,8 @@ async def home(request: Request):
         return RedirectResponse(url="/progress")
     
     try:
-        opcua_to_mqtt_status = "running" if is_process_running(OPCUA_TO_MQTT_SCRIPT) else "stopped"
-        mqtt_to_influx_status = "running" if is_process_running(MQTT_TO_INFLUX_SCRIPT) else "stopped"
+        opcua_to_mqtt_status = opcua_to_mqtt.status()["state"]
+        mqtt_to_influx_status = mqtt_to_influx.status()["state"]
     except Exception as e:
         logging.error(f"Error getting converter status: {e}")
         opcua_to_mqtt_status = mqtt_to_influx_status = "unknown"
@@ -239,32 +379,55 @@ async def home(request: Request):
 #         logging.error(f"Error adding node: {e}")
 #         return JSONResponse(content={"error": "Failed to add node"}, status_code=500)
 
+def replace_selection(node_ids):
+    # Under the lock, so a delta cannot slip in between reading the current rows and replacing them.
+    with node_catalog.lock:
+        rows = node_catalog.selection_rows(node_ids)
+        node_catalog.set_selection(rows)
+    return rows
+
 @app.post("/update")
 async def update_selected(request: UpdateRequest):
     try:
-        with open(NODES_CSV, mode='r') as file:
-            all_nodes = [row for row in csv.DictReader(file)]
-        selected_nodes = [node for node in all_nodes if node['NodeId'] in request.NodeIds]
-        with open(SELECTED_CSV, mode='w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=["DisplayName", "NodeId", "DataType"])
-            writer.writeheader()
-            writer.writerows(selected_nodes)
-        if is_process_running(OPCUA_TO_MQTT_SCRIPT):
-            stop_script(OPCUA_TO_MQTT_SCRIPT)
-            await asyncio.sleep(1)
-            await start_script(OPCUA_TO_MQTT_SCRIPT)
-            logging.info("OPC UA to MQTT converter restarted with new node selection")
+        selected_nodes = await run_blocking(replace_selection, request.NodeIds)
+        schedule_selected_csv_write(0, reload=True)
         logging.info(f"Selection updated. Selected nodes: {', '.join(request.NodeIds)}" if request.NodeIds else "Selection updated. No nodes selected.")
         return JSONResponse(content={"message": "Selection updated successfully" if request.NodeIds else "All nodes deselected", "selected_nodes": selected_nodes})
     except Exception as e:
         logging.error(f"Error updating selection: {e}")
         return JSONResponse(content={"error": "Failed to update selection"}, status_code=500)
 
+@app.post("/selection/add")
+async def add_to_selection(request: UpdateRequest):
+    rows = await run_blocking(node_catalog.get, dict.fromkeys(request.NodeIds))
+    unknown = sorted(set(request.NodeIds) - {row['NodeId'] for row in rows})
+    added = await run_blocking(node_catalog.add_selection, rows)
+    if added:
+        publish_control({"command": "add", "nodes": added})
+        schedule_selected_csv_write()
+        logging.info(f"Added to selection: {', '.join(row['NodeId'] for row in added)}")
+    return {"message": f"{len(added)} nodes added to selection", "added": [row['NodeId'] for row in added], "unknown": unknown}
+
+@app.post("/selection/remove")
+async def remove_from_selection(request: UpdateRequest):
+    removed = await run_blocking(node_catalog.remove_selection, dict.fromkeys(request.NodeIds))
+    if removed:
+        publish_control({"command": "remove", "NodeIds": removed})
+        schedule_selected_csv_write()
+        logging.info(f"Removed from selection: {', '.join(removed)}")
+    return {"message": f"{len(removed)} nodes removed from selection", "removed": removed}
+
+def clear_log_files():
+    for log_file in LOG_FILES.values():
+        open(log_file, 'w').close()
+        for index in range(1, LOG_BACKUP_COUNT + 1):
+            if os.path.exists(f"{log_file}.{index}"):
+                os.remove(f"{log_file}.{index}")
+
 @app.post("/clear_logs")
 async def clear_logs():
     try:
-        for log_file in [LOG_FILE, OPCUA_TO_MQTT_LOG_FILE, MQTT_TO_INFLUX_LOG_FILE]:
-            open(log_file, 'w').close()
+        await run_blocking(clear_log_files)
         return {"message": "All logs cleared successfully"}
     except Exception as e:
         logging.error(f"Error clearing logs: {e}")
@@ -272,15 +435,15 @@ async def clear_logs():
 
 @app.post("/toggle_opcua_to_mqtt")
 async def toggle_opcua_to_mqtt():
-    if is_process_running(OPCUA_TO_MQTT_SCRIPT):
-        if stop_script(OPCUA_TO_MQTT_SCRIPT):
+    if opcua_to_mqtt.desired:
+        if await opcua_to_mqtt.stop():
             logging.info("OPC UA to MQTT converter stopped")
             return {"message": "OPC UA to MQTT converter stopped"}
         else:
             logging.error("Failed to stop OPC UA to MQTT converter")
             return JSONResponse(content={"error": "Failed to stop converter"}, status_code=500)
     else:
-        if await start_script(OPCUA_TO_MQTT_SCRIPT):
+        if opcua_to_mqtt.start():
             logging.info("OPC UA to MQTT converter started")
             return {"message": "OPC UA to MQTT converter started"}
         else:
@@ -289,15 +452,15 @@ async def toggle_opcua_to_mqtt():
 
 @app.post("/toggle_mqtt_to_influx")
 async def toggle_mqtt_to_influx():
-    if is_process_running(MQTT_TO_INFLUX_SCRIPT):
-        if stop_script(MQTT_TO_INFLUX_SCRIPT):
+    if mqtt_to_influx.desired:
+        if await mqtt_to_influx.stop():
             logging.info("MQTT to InfluxDB converter stopped")
             return {"message": "MQTT to InfluxDB converter stopped"}
         else:
             logging.error("Failed to stop MQTT to InfluxDB converter")
             return JSONResponse(content={"error": "Failed to stop converter"}, status_code=500)
     else:
-        if await start_script(MQTT_TO_INFLUX_SCRIPT):
+        if mqtt_to_influx.start():
             logging.info("MQTT to InfluxDB converter started")
             return {"message": "MQTT to InfluxDB converter started"}
         else:
@@ -306,77 +469,141 @@ async def toggle_mqtt_to_influx():
 
 @app.get("/logs", response_class=HTMLResponse)
 async def get_logs(request: Request):
-    log_files = {"Application": LOG_FILE, "opcua_to_MQTT_Converter.py": OPCUA_TO_MQTT_LOG_FILE, "mqtt_to_Influx_Converter.py": MQTT_TO_INFLUX_LOG_FILE}
-    logs = {}
-    for script, log_file in log_files.items():
-        try:
-            with open(log_file, mode="r") as file:
-                logs[script] = file.readlines()
-        except Exception as e:
-            logs[script] = [f"Error reading log file: {e}\n"]
-    return templates.TemplateResponse("logs.html", {"request": request, "logs": logs})
-
-@app.get("/converter_status")
-async def get_converter_status():
-    return {"opcua_to_mqtt": "running" if is_process_running(OPCUA_TO_MQTT_SCRIPT) else "stopped", "mqtt_to_influx": "running" if is_process_running(MQTT_TO_INFLUX_SCRIPT) else "stopped"}
+    # The page fills itself from /logs/stream.
+    return templates.TemplateResponse("logs.html", {"request": request, "logs": list(LOG_FILES)})
+
+def parse_log_cursors(text):
+    # {"<log name>": [inode, offset], ...} as sent in event ids; raises ValueError for anything else.
+    cursors = json.loads(text)
+    if not isinstance(cursors, dict):
+        raise ValueError("expected an object")
+    for name, position in cursors.items():
+        if not (isinstance(position, list) and len(position) == 2 and all(type(value) is int and value >= 0 for value in position)):
+            raise ValueError(f"{name}: expected [inode, offset]")
+    return {name: tuple(position) for name, position in cursors.items() if name in LOG_FILES}
+
+@app.get("/logs/stream")
+async def stream_logs(request: Request, cursor: Optional[str] = None):
+    # Server-sent events: the last LOG_TAIL_LINES lines of each log, then only lines appended
+    # after that. Each event id carries the cursors of all logs, so a reconnecting EventSource
+    # (Last-Event-ID) or a client passing ?cursor= resumes where it left off.
+    try:
+        cursors = parse_log_cursors(cursor or request.headers.get("last-event-id") or "{}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid log cursor: {e}")
+
+    def event(name, lines):
+        return f"id: {json.dumps(cursors, separators=(',', ':'))}\ndata: {json.dumps({'log': name, 'lines': lines})}\n\n"
+
+    def read_new_lines():
+        # (name, lines) for every log with lines appended since its cursor.
+        found = []
+        for name, log_file in LOG_FILES.items():
+            lines, cursors[name] = read_after(log_file, cursors[name])
+            if lines:
+                found.append((name, lines))
+        return found
+
+    async def events():
+        for name, log_file in LOG_FILES.items():
+            if name in cursors:
+                continue
+            lines, cursors[name] = await run_blocking(tail_lines, log_file, LOG_TAIL_LINES)
+            yield event(name, lines)
+        idle = 0
+        while not await request.is_disconnected():
+            found = await run_blocking(read_new_lines)
+            for name, lines in found:
+                yield event(name, lines)
+            idle = 0 if found else idle + LOG_POLL_INTERVAL
+            if idle >= LOG_KEEPALIVE_INTERVAL:
+                idle = 0
+                yield ": keepalive\n\n"
+            await asyncio.sleep(LOG_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/converters")
+async def get_converters():
+    return supervisor.statuses()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus scrape target built from the stats the converters report to the supervisor.
+    return PlainTextResponse(render_metrics(supervisor.workers.values()), media_type="text/plain; version=0.0.4")
+
+@app.post("/converters/{name}/{action}")
+async def control_converter(name: str, action: Literal["start", "stop", "restart"]):
+    worker = supervisor.get(name)
+    if worker is None:
+        raise HTTPException(status_code=404, detail=f"Unknown converter: {name}")
+    if action == "start":
+        worker.start()
+    elif action == "stop":
+        await worker.stop()
+    else:
+        await worker.restart()
+    logging.info(f"Converter {name}: {action}")
+    return {"message": f"Converter {name}: {action}", "status": worker.status()}
 
 @app.get("/test_mqtt")
 async def test_mqtt():
-    try:
-        client = mqtt.Client()
-        client.connect("host.docker.internal", 1883, 60)
-        client.disconnect()
-        connection_status = True
-    except Exception as e:
-        logging.error(f"MQTT connection test failed: {e}")
-        connection_status = False
-    if connection_status:
-        logging.info("MQTT connection successful")
-        return {"message": "MQTT connection successful"}
-    else:
-        logging.error("MQTT connection failed")
-        return JSONResponse(content={"error": "MQTT connection failed"}, status_code=500)
+    # Answers from the shared connection's status instead of connecting to the broker.
+    status = mqtt_connection.status()
+    if status["connected"]:
+        return {"message": "MQTT connection successful", "status": status}
+    return JSONResponse(content={"error": f"MQTT connection failed: {status['error'] or 'not connected yet'}", "status": status}, status_code=500)
 
-@app.get("/get_latest_logs")
-async def get_latest_logs():
-    log_files = {"Application": LOG_FILE, "opcua_to_MQTT_Converter.py": OPCUA_TO_MQTT_LOG_FILE, "mqtt_to_Influx_Converter.py": MQTT_TO_INFLUX_LOG_FILE}
+@app.get("/health")
+async def health():
+    return {"mqtt": mqtt_connection.status(), "opcua": opcua_connection.status()}
+
+def read_latest_logs():
     latest_logs = {}
-    for script, log_file in log_files.items():
+    for script, log_file in LOG_FILES.items():
         try:
-            with open(log_file, mode="r") as file:
-                latest_logs[script] = file.readlines()[-100:][::-1]
+            latest_logs[script] = tail_lines(log_file, LOG_TAIL_LINES)[0][::-1]
         except Exception as e:
             latest_logs[script] = [f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Error reading log file: {e}\n"]
     return latest_logs
 
+@app.get("/get_latest_logs")
+async def get_latest_logs():
+    return await run_blocking(read_latest_logs)
+
 @app.post("/update_read_interval")
 async def update_read_interval(update: IntervalUpdate):
     os.environ['READ_INTERVAL'] = str(update.interval)
-    if is_process_running(OPCUA_TO_MQTT_SCRIPT):
-        stop_script(OPCUA_TO_MQTT_SCRIPT)
-        await asyncio.sleep(1)
-        await start_script(OPCUA_TO_MQTT_SCRIPT)
+    if opcua_to_mqtt.desired:
+        await opcua_to_mqtt.restart()
         logging.info(f"Read interval updated to {update.interval} seconds and OPC UA to MQTT converter restarted")
         return {"message": f"Read interval updated to {update.interval} seconds and OPC UA to MQTT converter restarted"}
     logging.info(f"Read interval updated to {update.interval} seconds")
     return {"message": f"Read interval updated to {update.interval} seconds"}
 
+@app.post("/update_acquisition_settings")
+async def update_acquisition_settings(settings: AcquisitionSettings):
+    os.environ['ACQUISITION_MODE'] = settings.mode
+    os.environ['PUBLISHING_INTERVAL'] = str(settings.publishing_interval)
+    os.environ['SAMPLING_INTERVAL'] = str(settings.sampling_interval)
+    os.environ['DEADBAND'] = str(settings.deadband)
+    message = f"Acquisition mode set to {settings.mode}"
+    if settings.mode == "subscription":
+        message += f" (publishing interval: {settings.publishing_interval} ms, sampling interval: {settings.sampling_interval} ms, deadband: {settings.deadband})"
+    if opcua_to_mqtt.desired:
+        await opcua_to_mqtt.restart()
+        message += " and OPC UA to MQTT converter restarted"
+    logging.info(message)
+    return {"message": message}
+
 @app.post("/toggle_both_converters")
 async def toggle_both_converters(toggle: ConverterToggle):
-    opcua_running = is_process_running(OPCUA_TO_MQTT_SCRIPT)
-    mqtt_running = is_process_running(MQTT_TO_INFLUX_SCRIPT)
-
     if toggle.turn_on:
-        if not opcua_running:
-            await start_script(OPCUA_TO_MQTT_SCRIPT)
-        if not mqtt_running:
-            await start_script(MQTT_TO_INFLUX_SCRIPT)
+        opcua_to_mqtt.start()
+        mqtt_to_influx.start()
         message = "Both converters turned on"
     else:
-        if opcua_running:
-            stop_script(OPCUA_TO_MQTT_SCRIPT)
-        if mqtt_running:
-            stop_script(MQTT_TO_INFLUX_SCRIPT)
+        await asyncio.gather(opcua_to_mqtt.stop(), mqtt_to_influx.stop())
         message = "Both converters turned off"
 
     logging.info(message)
@@ -384,20 +611,61 @@ async def toggle_both_converters(toggle: ConverterToggle):
 
 @app.get("/node_selection", response_class=HTMLResponse)
 async def node_selection(request: Request):
-    try:
-        with open(NODES_CSV, mode='r') as file:
-            nodes = [row for row in csv.DictReader(file)]
-        with open(SELECTED_CSV, mode='r') as file:
-            selected = {row['NodeId'] for row in csv.DictReader(file)}
-    except Exception as e:
-        logging.error(f"Error reading CSV files: {e}")
-        nodes, selected = [], set()
+    # Rows are loaded page by page from /nodes as the user scrolls.
     return templates.TemplateResponse("node_selection.html", {
         "request": request,
-        "nodes": nodes,
-        "selected": selected
+        "data_types": await run_blocking(node_catalog.data_types),
+        "node_count": await run_blocking(len, node_catalog)
     })
 
+@app.get("/nodes")
+async def search_nodes(q: str = "", match: Literal["substring", "prefix"] = "substring", data_type: Optional[str] = None,
+                       parent: Optional[str] = None, selected: Optional[bool] = None, cursor: int = 0, limit: int = 100):
+    nodes, next_cursor = await run_blocking(node_catalog.search, q, match, data_type, parent, selected, cursor, max(1, min(limit, 1000)))
+    return {"nodes": nodes, "next_cursor": next_cursor}
+
+@app.get("/nodes/data_types")
+async def get_data_types():
+    return await run_blocking(node_catalog.data_types)
+
+@app.get("/selection")
+async def get_selection():
+    return {"NodeIds": await run_blocking(node_catalog.selection)}
+
+@app.get("/values")
+async def get_values(node_id: Optional[List[str]] = Query(None), q: Optional[str] = None, since: Optional[int] = None):
+    # Latest value of each tag; since= (the seq of a previous response) returns only tags updated after it.
+    if since is None:
+        seq, values = value_cache.get(node_id, q)
+    else:
+        seq, values = value_cache.changes(since, node_id, q)
+    return {"seq": seq, "values": values}
+
+@app.websocket("/values/ws")
+async def stream_values(websocket: WebSocket, node_id: Optional[List[str]] = Query(None), q: Optional[str] = None):
+    # Sends the current values, then every VALUE_STREAM_INTERVAL the tags that changed.
+    await websocket.accept()
+    # Anything the client sends is ignored; receiving is only how a disconnect is noticed while idle.
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        seq, values = value_cache.get(node_id, q)
+        await websocket.send_json({"seq": seq, "values": values})
+        while True:
+            await asyncio.wait([receiver], timeout=VALUE_STREAM_INTERVAL)
+            if receiver.done():
+                if receiver.result()["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+            if value_cache.seq == seq:
+                continue
+            seq, values = value_cache.changes(seq, node_id, q)
+            if values:
+                await websocket.send_json({"seq": seq, "values": values})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+
 @app.get("/progress")
 async def progress(request: Request):
     return templates.TemplateResponse("progress.html", {"request": request, "progress": node_csv_exporter_progress})
@@ -0,0 +1,47 @@
+# Prometheus text exposition of the converter stats collected by the supervisor. Every stat a
+# converter reports becomes a gateway_<stat> series labelled with the converter and its shard;
+# stats in GAUGE_STATS are gauges, other numbers are counters since the converter started.
+PREFIX = "gateway_"
+GAUGE_STATS = {"nodes", "cycle_ms", "queue", "inflight", "pending", "spool_bytes"}
+# Identify the worker rather than measure it.
+SKIPPED_STATS = {"shard", "shards"}
+
+def render_metrics(workers):
+    # workers: the supervisor's ManagedProcess objects.
+    metrics = {}
+
+    def add(name, metric_type, labels, value, suffix=""):
+        entry = metrics.setdefault(PREFIX + name, (metric_type, []))
+        entry[1].append(f"{PREFIX}{name}{suffix}{{{labels}}} {value}")
+
+    for worker in workers:
+        status = worker.status()
+        converter, _, shard = worker.name.partition(".")
+        labels = f'converter="{converter}",shard="{shard or 0}"'
+        add("converter_up", "gauge", labels, int(status["state"] == "running"))
+        add("converter_restarts_total", "counter", labels, status["restarts"])
+        add("converter_throughput", "gauge", labels, status["throughput"])
+        if status["cpu_percent"] is not None:
+            add("converter_cpu_percent", "gauge", labels, status["cpu_percent"])
+            add("converter_rss_bytes", "gauge", labels, status["rss_bytes"])
+        if status["state"] != "running":
+            continue
+        for stat, value in status["stats"].items():
+            if stat in GAUGE_STATS:
+                if value is not None:
+                    add(stat, "gauge", labels, value)
+            elif stat not in SKIPPED_STATS and isinstance(value, (int, float)) and not isinstance(value, bool):
+                add(f"{stat}_total", "counter", labels, value)
+        for name, histogram in status["stats"].get("histograms", {}).items():
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                add(name, "histogram", f'{labels},le="{bound}"', cumulative, "_bucket")
+            add(name, "histogram", labels, histogram["sum"], "_sum")
+            add(name, "histogram", labels, histogram["count"], "_count")
+
+    lines = []
+    for name, (metric_type, samples) in metrics.items():
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
@@ -1,40 +1,323 @@
-import json
 import paho.mqtt.client as mqtt
-from influxdb_client import InfluxDBClient, Point
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
 import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from payload_codec import decode_samples
+from line_protocol import LineEncoder
+from spool import Spool
+from converter_stats import report_stats, Histogram, LATENCY_BUCKETS, LAG_BUCKETS, BATCH_BUCKETS
+from log_limit import RateLimitedLog
+from alias_registry import AliasRegistry
+from downsampler import Downsampler, parse_windows
 
-MQTT_BROKER = "host.docker.internal"
-MQTT_PORT = 1883
+MQTT_BROKER = os.environ.get('MQTT_BROKER', "host.docker.internal")
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
 MQTT_TOPIC = "plant1/#"
-INFLUXDB_URL = "host.docker.internal:8086"
+# Retained alias registry published by the app.
+MQTT_ALIAS_TOPIC = "opcua_to_mqtt/aliases"
+INFLUXDB_URL = os.environ.get('INFLUXDB_URL', "host.docker.internal:8086")
 INFLUXDB_ORG = "DataForge"
 INFLUXDB_BUCKET = "mqtt"
 INFLUXDB_TOKEN = os.environ.get('INFLUX_TOKEN')
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_JITTER_INTERVAL = 0.0
+DEFAULT_BUFFER_SIZE = 100000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_INTERVAL = 1.0
+DEFAULT_MAX_RETRY_DELAY = 30.0
+DEFAULT_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SPOOL_REPLAY_RATE = 100000
+DEFAULT_SPOOL_REPLAY_BATCH_SIZE = 50000
+SPOOL_DIR = "app/data/spool/mqtt_to_influx"
+STATS_INTERVAL = 10
+# Windowed aggregates written to sensor_data_<window>, e.g. "1,60,3600"; empty disables them.
+DOWNSAMPLE_WINDOWS = os.environ.get('DOWNSAMPLE_WINDOWS', "")
+# Set to 0 to write only the aggregates and not the raw samples.
+DOWNSAMPLE_RAW = os.environ.get('DOWNSAMPLE_RAW', "1") != "0"
+DEFAULT_DOWNSAMPLE_DELAY = 2.0
+# Status codes with these bits set (Uncertain, Bad) are left out of the aggregates.
+STATUS_SEVERITY_MASK = 0xC0000000
+# Lines whose source timestamp is checked per written batch for the end-to-end lag histogram.
+LAG_SAMPLES_PER_BATCH = 100
 
 influx_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 write_api = influx_client.write_api(write_options=SYNCHRONOUS)
 
+class BatchWriter:
+    # Collects line-protocol lines from the MQTT callback thread into a bounded buffer and writes
+    # them to InfluxDB in batches from its own thread, retrying failed batches with backoff.
+    # With a spool, batches that cannot be written go to disk at once and are retried from there
+    # with backoff, then replayed in order, in bulk and rate-limited, once InfluxDB accepts writes again.
+    def __init__(self, write_api, batch_size, flush_interval, jitter_interval, buffer_size, max_retries, retry_interval, max_retry_delay,
+                 spool=None, replay_rate=DEFAULT_SPOOL_REPLAY_RATE, replay_batch_size=DEFAULT_SPOOL_REPLAY_BATCH_SIZE):
+        self.write_api = write_api
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.jitter_interval = jitter_interval
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.max_retry_delay = max_retry_delay
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.replay_batch_size = replay_batch_size
+        self.replay_delay = retry_interval
+        self.next_replay = 0
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+        # Counters are only incremented from one thread each.
+        self.buffered = 0
+        self.dropped_full = 0
+        self.flushed = 0
+        self.retried = 0
+        self.dropped_failed = 0
+        self.spooled = 0
+        self.replayed = 0
+        # Samples whose alias is not in the registry yet; counted from the MQTT thread.
+        self.unresolved = 0
+        # Only observed from the writer thread.
+        self.histograms = {
+            "influx_write_seconds": Histogram(LATENCY_BUCKETS),
+            "influx_batch_points": Histogram(BATCH_BUCKETS),
+            "pipeline_lag_seconds": Histogram(LAG_BUCKETS),
+        }
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, line):
+        try:
+            self.buffer.put_nowait(line)
+            self.buffered += 1
+        except queue.Full:
+            self.dropped_full += 1
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def describe(self):
+        description = (f"buffered: {self.buffered}, flushed: {self.flushed}, retried: {self.retried}, "
+                       f"dropped: {self.dropped_full + self.dropped_failed}, pending: {self.buffer.qsize()}")
+        if self.spool is not None:
+            description += f", spooled: {self.spooled}, replayed: {self.replayed}, {self.spool.describe()}"
+        return description
+
+    def report(self):
+        # Counters for the app's supervisor; "samples" counts points written to InfluxDB.
+        report_stats(
+            samples=self.flushed,
+            buffered=self.buffered,
+            flushed=self.flushed,
+            retried=self.retried,
+            dropped=self.dropped_full + self.dropped_failed,
+            pending=self.buffer.qsize(),
+            spooled=self.spooled,
+            replayed=self.replayed,
+            unresolved=self.unresolved,
+            spool_bytes=self.spool.size() if self.spool is not None else 0,
+            histograms={name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        )
+
+    def _observe_write(self, lines, started):
+        # Lag from the OPC UA source timestamp to the write, on a sample of the lines that carry one.
+        now = time.time()
+        self.histograms["influx_write_seconds"].observe(time.monotonic() - started)
+        self.histograms["influx_batch_points"].observe(len(lines))
+        lag = self.histograms["pipeline_lag_seconds"]
+        for line in lines[::max(1, len(lines) // LAG_SAMPLES_PER_BATCH)]:
+            if b",status=" in line:
+                lag.observe(max(0.0, now - int(line[line.rindex(b" ") + 1:]) / 1000))
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        if self.spool is not None and not self.spool.empty():
+            deadline = min(deadline, max(self.next_replay, time.monotonic()))
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.buffer.get(timeout=timeout) if timeout > 0 else self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        last_stats = time.monotonic()
+        while not (self.stopping.is_set() and self.buffer.empty()):
+            batch = self._next_batch()
+            if batch:
+                if self.jitter_interval > 0 and not self.stopping.is_set():
+                    time.sleep(random.uniform(0, self.jitter_interval))
+                if self.spool is not None and not self.spool.empty():
+                    # Older points are still on disk; queue behind them to keep order.
+                    self._spool(batch)
+                else:
+                    self._write(batch)
+            if self.spool is not None and not self.spool.empty() and not self.stopping.is_set() and time.monotonic() >= self.next_replay:
+                self._replay()
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                print(f"Influx writer: {self.describe()}")
+                self.report()
+
+    def _write(self, batch):
+        payload = b"\n".join(batch)
+        delay = self.retry_interval
+        for attempt in range(self.max_retries + 1):
+            try:
+                started = time.monotonic()
+                self.write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=payload, write_precision=WritePrecision.MS)
+                self.flushed += len(batch)
+                self._observe_write(batch, started)
+                return
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable and self.spool is not None:
+                    # Retried from the spool by _replay with backoff, so this thread keeps draining
+                    # the buffer instead of sleeping while it fills up.
+                    print(f"Error writing batch of {len(batch)} points: {e}, spooling to disk until InfluxDB is back")
+                    self._spool(batch)
+                    self.next_replay = time.monotonic() + self.replay_delay
+                    return
+                if not retryable or attempt == self.max_retries or self.stopping.is_set():
+                    print(f"Error writing batch of {len(batch)} points, dropping it: {e}")
+                    self.dropped_failed += len(batch)
+                    return
+                self.retried += len(batch)
+                print(f"Error writing batch of {len(batch)} points (attempt {attempt + 1}): {e}, retrying in {delay:.1f} s")
+                time.sleep(delay + random.uniform(0, self.jitter_interval))
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _spool(self, batch):
+        self.spool.append(batch)
+        self.spooled += len(batch)
+
+    def _replay(self):
+        lines = self.spool.read(self.replay_batch_size)
+        started = time.monotonic()
+        try:
+            self.write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=b"\n".join(lines), write_precision=WritePrecision.MS)
+        except Exception as e:
+            if is_retryable(e):
+                self.retried += len(lines)
+                self.next_replay = time.monotonic() + self.replay_delay + random.uniform(0, self.jitter_interval)
+                self.replay_delay = min(self.replay_delay * 2, self.max_retry_delay)
+                return
+            print(f"Error replaying {len(lines)} spooled points, dropping them: {e}")
+            self.dropped_failed += len(lines)
+        else:
+            self.replayed += len(lines)
+            self.flushed += len(lines)
+            self._observe_write(lines, started)
+            if self.replay_delay != self.retry_interval:
+                print("InfluxDB is reachable again, replaying spooled points")
+            self.replay_delay = self.retry_interval
+        self.spool.commit()
+        # Spread the catch-up so it does not swamp InfluxDB.
+        self.next_replay = time.monotonic() + len(lines) / self.replay_rate
+
+def is_retryable(e):
+    # Client errors (bad data, auth) will not succeed on a retry; 429 means back off.
+    return not isinstance(e, ApiException) or e.status is None or e.status == 429 or e.status >= 500
+
+spool_max_bytes = int(os.environ.get('SPOOL_MAX_BYTES', DEFAULT_SPOOL_MAX_BYTES))
+
+batch_writer = BatchWriter(
+    write_api,
+    batch_size=int(os.environ.get('INFLUX_BATCH_SIZE', DEFAULT_BATCH_SIZE)),
+    flush_interval=float(os.environ.get('INFLUX_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)),
+    jitter_interval=float(os.environ.get('INFLUX_JITTER_INTERVAL', DEFAULT_JITTER_INTERVAL)),
+    buffer_size=int(os.environ.get('INFLUX_BUFFER_SIZE', DEFAULT_BUFFER_SIZE)),
+    max_retries=int(os.environ.get('INFLUX_MAX_RETRIES', DEFAULT_MAX_RETRIES)),
+    retry_interval=float(os.environ.get('INFLUX_RETRY_INTERVAL', DEFAULT_RETRY_INTERVAL)),
+    max_retry_delay=float(os.environ.get('INFLUX_MAX_RETRY_DELAY', DEFAULT_MAX_RETRY_DELAY)),
+    spool=Spool(SPOOL_DIR, spool_max_bytes) if spool_max_bytes > 0 else None,
+    replay_rate=float(os.environ.get('SPOOL_REPLAY_RATE', DEFAULT_SPOOL_REPLAY_RATE)),
+    replay_batch_size=int(os.environ.get('SPOOL_REPLAY_BATCH_SIZE', DEFAULT_SPOOL_REPLAY_BATCH_SIZE)),
+)
+
+line_encoder = LineEncoder("sensor_data", "sensor")
+downsampler = None
+if DOWNSAMPLE_WINDOWS:
+    downsampler = Downsampler(parse_windows(DOWNSAMPLE_WINDOWS), batch_writer.add, line_encoder.aggregate_prefix,
+                              delay=float(os.environ.get('DOWNSAMPLE_DELAY', DEFAULT_DOWNSAMPLE_DELAY)))
+write_raw = DOWNSAMPLE_RAW or downsampler is None
+message_error_log = RateLimitedLog()
+# Line prefixes indexed by alias, rebuilt whenever a new registry version arrives.
+alias_prefixes = []
+alias_version = 0
+
 def on_connect(client, userdata, flags, rc):
     print("Connected to MQTT Broker" if rc == 0 else f"Connection failed, rc: {rc}")
-    client.subscribe(MQTT_TOPIC)
+    # The registry topic first, so the retained registry arrives before aliased samples.
+    client.subscribe([(MQTT_ALIAS_TOPIC, 1), (MQTT_TOPIC, 0)])
+
+def on_alias_message(client, userdata, msg):
+    global alias_prefixes, alias_version
+    try:
+        registry = AliasRegistry.loads(msg.payload)
+    except Exception as e:
+        print(f"Error loading alias registry: {e}")
+        return
+    alias_prefixes = [line_encoder.series_prefix(series_key) for series_key in registry.series_keys()]
+    alias_version = registry.version
+    print(f"Loaded alias registry version {alias_version}: {len(alias_prefixes)} aliases")
 
 def on_message(client, userdata, msg):
     try:
-        data = json.loads(msg.payload.decode().replace("'", '"'))
-        sensor_name = data.get("node_id", "unknown_sensor")
-        sensor_value = float(data.get("value", 0))
-        
-        point = Point("sensor_data").tag("sensor", sensor_name).field("value", sensor_value)
-        write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=point)
-        print(f"Data written: {sensor_name} = {sensor_value}")
+        samples = decode_samples(msg.payload)
     except Exception as e:
-        print(f"Error processing message: {e}")
+        if message_error_log.due():
+            message_error_log.print(f"Error processing message: {e}")
+        return
+    prefixes = alias_prefixes
+    # Samples for the downsampler, handed over once per message.
+    series, values, timestamps = [], [], []
+    received = int(time.time() * 1000)
+    for sensor_name, value, timestamp, status in samples:
+        try:
+            if value is None:
+                continue
+            # Batched payloads carry the OPC UA source timestamp and status code, and an alias
+            # instead of the sensor name for nodes in the registry.
+            if sensor_name.__class__ is int:
+                if sensor_name >= len(prefixes):
+                    batch_writer.unresolved += 1
+                    if message_error_log.due():
+                        message_error_log.print(f"Unknown alias {sensor_name} (registry version {alias_version})")
+                    continue
+                prefix = prefixes[sensor_name]
+            else:
+                prefix = line_encoder.prefixes.get(sensor_name) or line_encoder.prefix(sensor_name)
+            line = line_encoder.encode_prefixed(prefix, value, timestamp, status)
+            if line is None:
+                continue
+            if write_raw:
+                batch_writer.add(line)
+            if downsampler is not None and not status & STATUS_SEVERITY_MASK:
+                series.append(prefix)
+                values.append(value)
+                timestamps.append(received if timestamp is None else timestamp)
+        except Exception as e:
+            if message_error_log.due():
+                message_error_log.print(f"Error processing sample {sensor_name}: {e}")
+    if series:
+        downsampler.add(series, values, timestamps)
 
 def connect_mqtt():
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
+    client.message_callback_add(MQTT_ALIAS_TOPIC, on_alias_message)
     try:
         client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
         print("MQTT client connection initiated")
@@ -44,8 +327,13 @@ def connect_mqtt():
         return None
 
 # Main execution
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 try:
     print("Connecting to MQTT Broker...")
+    batch_writer.start()
+    if downsampler is not None:
+        print(f"Downsampling to {', '.join(window.label for window in downsampler.windows)} windows, raw samples {'kept' if write_raw else 'not written'}")
+        downsampler.start()
     mqtt_client = connect_mqtt()
     if mqtt_client:
         # Start the loop only if connection was successful
@@ -53,4 +341,10 @@ try:
     else:
         print("Failed to establish MQTT connection")
 except Exception as e:
-    print(f"Error in main execution: {e}")
\ No newline at end of file
+    print(f"Error in main execution: {e}")
+finally:
+    if downsampler is not None:
+        downsampler.close()
+        print(f"Downsampler: {downsampler.describe()}")
+    batch_writer.close()
+    print(f"Influx writer: {batch_writer.describe()}")
@@ -0,0 +1,198 @@
+import csv
+import os
+import sqlite3
+import threading
+
+# Searchable copy of the exported address space plus the current node selection, so the node
+# selection page and /update never have to hold the whole node list. The CSV files stay the
+# bulk import/export format; load_csv replaces the catalog with the contents of one.
+# Substring search uses an FTS5 trigram index on DisplayName and BrowseName, which needs at least
+# three characters; shorter terms fall back to a scan.
+# The app calls the catalog from a thread pool. All threads share one connection, so writes hold
+# the lock to keep their transactions apart; callers that read the selection across several
+# calls (e.g. to write selected.csv) hold it as well.
+TRIGRAM_MIN_LENGTH = 3
+LOOKUP_CHUNK_SIZE = 500
+# Optional selected.csv columns kept with the selection: the node's server and its change filter settings.
+OPTIONAL_SELECTED_COLUMNS = {"ServerUrl": "server_url", "Deadband": "deadband", "Heartbeat": "heartbeat"}
+
+class NodeCatalog:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                display_name TEXT COLLATE NOCASE,
+                browse_name TEXT COLLATE NOCASE,
+                data_type TEXT,
+                parent_id TEXT,
+                description TEXT
+            );
+            CREATE INDEX IF NOT EXISTS nodes_display_name ON nodes (display_name);
+            CREATE INDEX IF NOT EXISTS nodes_browse_name ON nodes (browse_name);
+            CREATE INDEX IF NOT EXISTS nodes_data_type ON nodes (data_type);
+            CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts5(
+                display_name, browse_name, content='nodes', content_rowid='rowid', tokenize='trigram'
+            );
+        """)
+        # The selection keeps its own copy of the selected.csv columns, so nodes missing from the
+        # catalog (or carrying optional columns) survive rewrites of selected.csv.
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(selected)")]
+        if "display_name" not in columns:
+            self.db.execute("DROP TABLE IF EXISTS selected")
+            columns = []
+        self.db.execute("CREATE TABLE IF NOT EXISTS selected (node_id TEXT PRIMARY KEY, display_name TEXT, data_type TEXT, server_url TEXT, deadband TEXT, heartbeat TEXT)")
+        for column in ("deadband", "heartbeat"):
+            if columns and column not in columns:
+                self.db.execute(f"ALTER TABLE selected ADD COLUMN {column} TEXT")
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def load_csv(self, path):
+        # Bulk load from nodes.csv or nodes_output.csv; columns missing from the file are left empty.
+        with self.lock, open(path, newline='') as file, self.db:
+            self.db.execute("DELETE FROM nodes")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO nodes (node_id, display_name, browse_name, data_type, parent_id, description) VALUES (?, ?, ?, ?, ?, ?)",
+                ((row['NodeId'], row.get('DisplayName'), row.get('BrowseName'), row.get('DataType') or None, row.get('ParentNodeId') or None, row.get('Description'))
+                 for row in csv.DictReader(file) if row.get('NodeId')))
+            self.db.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('rebuild')")
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"source:{path}", self._signature(path)))
+
+    def sync_csv(self, path):
+        # Loads path only if it changed since it was last loaded. Returns True if it was loaded.
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (f"source:{path}",)).fetchone()
+            if row and row[0] == self._signature(path):
+                return False
+            self.load_csv(path)
+            return True
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def dump_csv(self):
+        # Yields nodes.csv lines (DisplayName, NodeId, DataType) without building the file in memory.
+        yield "DisplayName,NodeId,DataType\r\n"
+        line = _Line()
+        writer = csv.writer(line)
+        for row in self.db.execute("SELECT display_name, node_id, data_type FROM nodes ORDER BY rowid"):
+            writer.writerow(row)
+            yield line.pop()
+
+    def search(self, query="", match="substring", data_type=None, parent_id=None, selected=None, cursor=0, limit=100):
+        # Returns (rows, next_cursor). The cursor is the rowid of the last row returned, so pages stay
+        # stable while the user scrolls; next_cursor is None on the last page.
+        conditions = ["nodes.rowid > ?"]
+        params = [cursor]
+        if query:
+            if match == "prefix":
+                escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                conditions.append("(nodes.display_name LIKE ? ESCAPE '\\' OR nodes.browse_name LIKE ? ESCAPE '\\')")
+                params += [escaped, escaped]
+            elif len(query) >= TRIGRAM_MIN_LENGTH:
+                conditions.append("nodes.rowid IN (SELECT rowid FROM nodes_fts WHERE nodes_fts MATCH ?)")
+                params.append('"' + query.replace('"', '""') + '"')
+            else:
+                escaped = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                conditions.append("(nodes.display_name LIKE ? ESCAPE '\\' OR nodes.browse_name LIKE ? ESCAPE '\\')")
+                params += [escaped, escaped]
+        if data_type:
+            conditions.append("nodes.data_type = ?")
+            params.append(data_type)
+        if parent_id:
+            conditions.append("nodes.parent_id = ?")
+            params.append(parent_id)
+        if selected is not None:
+            conditions.append("selected.node_id IS NOT NULL" if selected else "selected.node_id IS NULL")
+        rows = self.db.execute(f"""
+            SELECT nodes.rowid, nodes.node_id, nodes.display_name, nodes.browse_name, nodes.data_type, nodes.parent_id, selected.node_id IS NOT NULL
+            FROM nodes LEFT JOIN selected ON selected.node_id = nodes.node_id
+            WHERE {' AND '.join(conditions)} ORDER BY nodes.rowid LIMIT ?""", params + [limit]).fetchall()
+        nodes = [{"NodeId": node_id, "DisplayName": display_name, "BrowseName": browse_name, "DataType": data_type, "ParentNodeId": parent, "selected": bool(is_selected)}
+                 for _, node_id, display_name, browse_name, data_type, parent, is_selected in rows]
+        return nodes, (rows[-1][0] if len(rows) == limit else None)
+
+    def data_types(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT data_type FROM nodes WHERE data_type IS NOT NULL ORDER BY data_type")]
+
+    def get(self, node_ids):
+        # Catalog rows for the given NodeIds as selected.csv rows, in catalog order; unknown ids are skipped.
+        node_ids = list(node_ids)
+        rows = []
+        for i in range(0, len(node_ids), LOOKUP_CHUNK_SIZE):
+            chunk = node_ids[i:i + LOOKUP_CHUNK_SIZE]
+            rows += self.db.execute(f"SELECT rowid, display_name, node_id, data_type FROM nodes WHERE node_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        return [{"DisplayName": display_name, "NodeId": node_id, "DataType": data_type or ""} for _, display_name, node_id, data_type in sorted(rows)]
+
+    def selection_rows(self, node_ids):
+        # selected.csv rows for a new selection of node_ids, in that order. Catalog rows are merged
+        # over the current row of nodes that stay selected, so their optional columns survive;
+        # selected nodes missing from the catalog keep their current row. Other unknown ids are skipped.
+        node_ids = list(dict.fromkeys(node_ids))
+        catalog = {row['NodeId']: row for row in self.get(node_ids)}
+        current = {row['NodeId']: row for row in self.selected_rows()}
+        rows = []
+        for node_id in node_ids:
+            row = {**current.get(node_id, {}), **{name: value for name, value in catalog.get(node_id, {}).items() if value}}
+            if row:
+                rows.append(row)
+        return rows
+
+    def selection(self):
+        return [row[0] for row in self.db.execute("SELECT node_id FROM selected ORDER BY rowid")]
+
+    def selected_rows(self):
+        # selected.csv rows in the order the nodes were selected.
+        for node_id, display_name, data_type, *optional in self.db.execute(f"SELECT node_id, display_name, data_type, {', '.join(OPTIONAL_SELECTED_COLUMNS.values())} FROM selected ORDER BY rowid"):
+            row = {"DisplayName": display_name or "", "NodeId": node_id, "DataType": data_type or ""}
+            for name, value in zip(OPTIONAL_SELECTED_COLUMNS, optional):
+                if value:
+                    row[name] = value
+            yield row
+
+    def optional_columns(self):
+        # The optional selected.csv columns that at least one selected node has a value for.
+        return [name for name, column in OPTIONAL_SELECTED_COLUMNS.items()
+                if self.db.execute(f"SELECT 1 FROM selected WHERE {column} IS NOT NULL LIMIT 1").fetchone() is not None]
+
+    def set_selection(self, rows):
+        # rows: selected.csv rows (dicts with NodeId and optionally DisplayName, DataType, ServerUrl, Deadband, Heartbeat).
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM selected")
+            self._insert_selected(rows)
+
+    def add_selection(self, rows):
+        # Returns the rows that were not selected yet.
+        with self.lock, self.db:
+            return self._insert_selected(rows)
+
+    def remove_selection(self, node_ids):
+        # Returns the NodeIds that were selected.
+        with self.lock, self.db:
+            return [node_id for node_id in node_ids if self.db.execute("DELETE FROM selected WHERE node_id = ?", (node_id,)).rowcount]
+
+    def _insert_selected(self, rows):
+        return [row for row in rows if self.db.execute("INSERT OR IGNORE INTO selected (node_id, display_name, data_type, server_url, deadband, heartbeat) VALUES (?, ?, ?, ?, ?, ?)",
+                                                       (row['NodeId'], row.get('DisplayName'), row.get('DataType') or None, row.get('ServerUrl') or None,
+                                                        row.get('Deadband') or None, row.get('Heartbeat') or None)).rowcount]
+
+class _Line:
+    # File-like target for csv.writer that hands back each written line.
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def pop(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
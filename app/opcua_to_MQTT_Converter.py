@@ -1,53 +1,753 @@
-from opcua import Client
-from paho.mqtt import client as mqtt_client
+from asyncua import Client, ua
+import paho.mqtt.client as mqtt
+from collections import defaultdict, deque
+from datetime import timezone
+from payload_codec import PAYLOAD_FORMATS, encode_samples, decode_samples
+from spool import Spool
+from converter_stats import report_stats, Histogram, LATENCY_BUCKETS
+from log_limit import RateLimitedLog
+from change_filter import load_defaults, make_filter
+from alias_registry import AliasRegistry, short_name
+import asyncio
+import signal
 import time
 import json
 import csv
 import os
+import zlib
 
-OPC_SERVER_URL = "opc.tcp://100.94.111.58:4841"
-MQTT_BROKER = "host.docker.internal"
-MQTT_PORT = 1883
+OPC_SERVER_URL = os.environ.get('OPCUA_SERVER_URL', "opc.tcp://100.94.111.58:4841")
+MQTT_BROKER = os.environ.get('MQTT_BROKER', "host.docker.internal")
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
 MQTT_TOPIC = "plant1"
-SELECTED_CSV = "app/data/selected.csv"
+MQTT_CONTROL_TOPIC = "opcua_to_mqtt/control"
+SELECTED_CSV = os.environ.get('SELECTED_CSV', "app/data/selected.csv")
+# Alias registry written by the app; batched payloads carry aliases for the nodes in it.
+ALIAS_FILE = os.environ.get('ALIAS_FILE', "app/data/aliases.json")
 DEFAULT_READ_INTERVAL = 5
+DEFAULT_READ_CHUNK_SIZE = 500
+DEFAULT_ACQUISITION_MODE = "poll"
+DEFAULT_PUBLISHING_INTERVAL = 1000
+DEFAULT_SAMPLING_INTERVAL = 500
+DEFAULT_DEADBAND = 0.0
+# DataTypes the server-side Absolute deadband applies to; other nodes are monitored without it.
+NUMERIC_DATA_TYPES = {"SByte", "Byte", "Int16", "UInt16", "Int32", "UInt32", "Int64", "UInt64", "Float", "Double"}
+# Item results meaning the server will not apply the deadband to the node; such items are
+# monitored again without it.
+FILTER_REJECTED = {ua.StatusCodes.BadFilterNotAllowed, ua.StatusCodes.BadMonitoredItemFilterUnsupported, ua.StatusCodes.BadDeadbandFilterInvalid}
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_QUEUE_FULL_POLICY = "block"
+DEFAULT_MQTT_MAX_PENDING = 1000
+DEFAULT_PAYLOAD_FORMAT = "single"
+DEFAULT_PAYLOAD_MAX_SAMPLES = 5000
+DEFAULT_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SPOOL_REPLAY_RATE = 20000
+SPOOL_DIR = "app/data/spool/opcua_to_mqtt"
+SPOOL_REPLAY_RECORDS = 1000
+RECONNECT_DELAY = 5
+SELECTION_CHECK_INTERVAL = 1
+STATS_INTERVAL = 5
+HEARTBEAT_CHECK_INTERVAL = 1
+# How often an idle subscription reads the server state to notice a dead session.
+SESSION_CHECK_INTERVAL = 10
+SESSION_CHECK_TIMEOUT = 5
+DEFAULT_SHARD_STRATEGY = "hash"
+# Set by the app's supervisor when it runs several converter processes over one selection.
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', 0))
+SHARD_COUNT = max(1, int(os.environ.get('SHARD_COUNT', 1)))
+SHARD_LABEL = f" shard {SHARD_INDEX}/{SHARD_COUNT}" if SHARD_COUNT > 1 else ""
+published_log = RateLimitedLog()
+read_error_log = RateLimitedLog()
+# Duration in ms of the latest poll cycle of each (server url, namespace) group in this process.
+cycle_times = {}
+# Samples held back by the change filters, unchanged values republished as heartbeats, and poll
+# cycles that took longer than the read interval.
+counters = {"suppressed": 0, "heartbeats": 0, "overruns": 0}
+histograms = {"opcua_read_seconds": Histogram(LATENCY_BUCKETS), "opcua_cycle_seconds": Histogram(LATENCY_BUCKETS)}
 
-def read_selected_nodes():
-    with open(SELECTED_CSV, mode='r') as file:
-        return [row['NodeId'] for row in csv.DictReader(file)]
+class SelectedNode:
+    __slots__ = ("node_id", "nodeid", "key", "filter", "data_type")
+
+    def __init__(self, node_id, nodeid, change_filter=None, alias=None, data_type=None):
+        self.node_id = node_id
+        self.nodeid = nodeid
+        # What samples of this node are published under: its alias, or its sensor name.
+        self.key = short_name(node_id) if alias is None else alias
+        self.filter = change_filter
+        self.data_type = data_type
+
+def filter_defaults():
+    try:
+        return load_defaults()
+    except ValueError as e:
+        print(f"Error parsing COV_DATATYPE_DEFAULTS: {e}")
+        return {None: {}}
+
+def parse_row(row, defaults):
+    # Returns (node_id, ua.NodeId, ChangeFilter or None, DataType) for a selected.csv row, or None if it is invalid.
+    node_id = row['NodeId']
+    try:
+        nodeid = ua.NodeId.from_string(node_id)
+    except Exception as e:
+        print(f"Error parsing {node_id}: {e}")
+        return None
+    try:
+        change_filter = make_filter(row, defaults)
+    except ValueError as e:
+        # A bad Deadband or Heartbeat only costs the node its filter, not its samples.
+        print(f"Error parsing the change filter of {node_id}: {e}, publishing every sample")
+        change_filter = None
+    return node_id, nodeid, change_filter, row.get('DataType') or None
+
+def subtree(node_id):
+    # String NodeIds are dotted paths (ns=2;s=DB15.R202_XTT610); group nodes by their parent path.
+    return node_id.rsplit('.', 1)[0]
+
+def shard_node_ids(node_ids, shard_index, shard_count, strategy):
+    # Every shard reads the whole selection and keeps its own part, so the shards agree
+    # without talking to each other and rebalance whenever the selection is reloaded.
+    if shard_count <= 1:
+        return set(node_ids)
+    if strategy == "subtree":
+        # Keep each subtree on one shard; hand out the largest subtrees first to the least loaded shard.
+        subtrees = defaultdict(list)
+        for node_id in node_ids:
+            subtrees[subtree(node_id)].append(node_id)
+        loads = [0] * shard_count
+        owned = set()
+        for key in sorted(subtrees, key=lambda key: (-len(subtrees[key]), key)):
+            shard = loads.index(min(loads))
+            loads[shard] += len(subtrees[key])
+            if shard == shard_index:
+                owned.update(subtrees[key])
+        return owned
+    return {node_id for node_id in node_ids if zlib.crc32(node_id.encode()) % shard_count == shard_index}
+
+class NodeSelection:
+    # Parsed contents of selected.csv, grouped by (server url, namespace index).
+    # Reloaded only when the file changes or a reload is requested. Nodes whose settings did not
+    # change keep their SelectedNode, and with it their change filter state, so the rewrite of
+    # selected.csv that follows every add/remove delta does not republish them; a reload that
+    # changes nothing does not wake the readers at all.
+    # With alias_path, nodes in the alias registry are published under their aliases.
+    def __init__(self, path, alias_path=None):
+        self.path = path
+        self.alias_path = alias_path
+        self.aliases = AliasRegistry()
+        self.mtime = None
+        self.groups = {}
+        self.version = 0
+        self._changed = asyncio.Event()
+        self._reload_requested = asyncio.Event()
+
+    def load(self):
+        groups = defaultdict(dict)
+        rows = []
+        defaults = filter_defaults()
+        if self.alias_path:
+            # The app saves the registry before rewriting selected.csv, so it covers the new selection.
+            try:
+                self.aliases = AliasRegistry.load(self.alias_path)
+            except Exception as e:
+                print(f"Error reading {self.alias_path}: {e}")
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, mode='r') as file:
+                for row in csv.DictReader(file):
+                    # Rows may name their own server in an optional ServerUrl column.
+                    parsed = parse_row(row, defaults)
+                    if parsed is not None:
+                        rows.append((row.get('ServerUrl') or OPC_SERVER_URL, *parsed))
+        except Exception as e:
+            print(f"Error reading {self.path}: {e}")
+            mtime = None
+        owned = shard_node_ids([row[1] for row in rows], SHARD_INDEX, SHARD_COUNT, os.environ.get('SHARD_STRATEGY', DEFAULT_SHARD_STRATEGY))
+        previous = {node_id: (group, selected) for group, nodes in self.groups.items() for node_id, selected in nodes.items()}
+        changed = 0
+        for server_url, node_id, nodeid, change_filter, data_type in rows:
+            if node_id not in owned:
+                continue
+            group = (server_url, nodeid.NamespaceIndex)
+            selected = SelectedNode(node_id, nodeid, change_filter, self.aliases.alias(node_id), data_type)
+            old_group, old = previous.get(node_id, (None, None))
+            if old is not None:
+                if change_filter is not None and old.filter is not None and change_filter.settings() == old.filter.settings():
+                    selected.filter = old.filter
+                if old_group == group and old.nodeid == nodeid and old.key == selected.key and old.data_type == data_type and old.filter is selected.filter:
+                    selected = old
+            if selected is not old:
+                changed += 1
+            groups[group][node_id] = selected
+        current = {node_id for nodes in groups.values() for node_id in nodes}
+        removed = sum(node_id not in current for node_id in previous)
+        self.mtime = mtime
+        if not changed and not removed and self.version:
+            print(f"Reloaded selection{SHARD_LABEL}: unchanged, {self.size()} nodes")
+            return
+        self.groups = dict(groups)
+        self._bump()
+        aliased = sum(isinstance(selected.key, int) for nodes in self.groups.values() for selected in nodes.values())
+        print(f"Loaded selection{SHARD_LABEL}: {self.size()} of {len(rows)} nodes in {len(self.groups)} groups, {changed} new or changed, {removed} removed"
+              + (f", {aliased} with aliases (registry version {self.aliases.version})" if self.alias_path else ""))
+
+    def _bump(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add(self, rows):
+        # Live additions from the app, rows as in selected.csv. The app rewrites selected.csv
+        # shortly afterwards, so the reload that follows ends up with the same nodes.
+        if SHARD_COUNT > 1 and os.environ.get('SHARD_STRATEGY', DEFAULT_SHARD_STRATEGY) == "subtree":
+            # Subtree shards are balanced over the whole selection; wait for the rewritten file.
+            return
+        owned = shard_node_ids([row['NodeId'] for row in rows], SHARD_INDEX, SHARD_COUNT, "hash")
+        defaults = filter_defaults()
+        added = 0
+        for row in rows:
+            if row['NodeId'] not in owned:
+                continue
+            parsed = parse_row(row, defaults)
+            if parsed is None:
+                continue
+            node_id, nodeid, change_filter, data_type = parsed
+            self.groups.setdefault((row.get('ServerUrl') or OPC_SERVER_URL, nodeid.NamespaceIndex), {})[node_id] = SelectedNode(node_id, nodeid, change_filter, self.aliases.alias(node_id), data_type)
+            added += 1
+        if added:
+            self._bump()
+            print(f"Added {added} nodes to selection{SHARD_LABEL}, now {self.size()} nodes")
+
+    def remove(self, node_ids):
+        removed = 0
+        for node_id in node_ids:
+            for key, nodes in list(self.groups.items()):
+                if nodes.pop(node_id, None) is not None:
+                    removed += 1
+                    if not nodes:
+                        del self.groups[key]
+                    break
+        if removed:
+            self._bump()
+            print(f"Removed {removed} nodes from selection{SHARD_LABEL}, now {self.size()} nodes")
+
+    def size(self):
+        return sum(len(nodes) for nodes in self.groups.values())
+
+    def request_reload(self):
+        self._reload_requested.set()
+
+    async def watch(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), SELECTION_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            forced = self._reload_requested.is_set()
+            self._reload_requested.clear()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if forced or mtime != self.mtime:
+                self.load()
+
+    async def wait_for_change(self, version):
+        while self.version == version:
+            await self._changed.wait()
+
+    def servers(self):
+        return {server_url for server_url, _ in self.groups} or {OPC_SERVER_URL}
+
+    def namespaces(self, server_url):
+        return {namespace for url, namespace in self.groups if url == server_url}
+
+    def nodes(self, server_url, namespace):
+        return self.groups.get((server_url, namespace), {})
 
 def connect_mqtt():
-    client = mqtt_client.Client()
-    client.connect(MQTT_BROKER, MQTT_PORT)
-    print("Connected to MQTT Broker")
+    # Connect in the background so acquisition (and spooling) starts even if the broker is down.
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.connect_async(MQTT_BROKER, MQTT_PORT)
+    client.loop_start()
     return client
 
-def read_opcua_data(opcua_client, mqtt_client):
-    opcua_client.connect()
-    print("Connected to OPC UA server")
+def on_connect(client, userdata, flags, rc):
+    print("Connected to MQTT Broker" if rc == 0 else f"Connection failed, rc: {rc}")
+    client.subscribe(MQTT_CONTROL_TOPIC)
 
-    while True:
-        for node_id in read_selected_nodes():
+def subscribe_control(mqtt_client, selection, loop):
+    # {"command": "reload"} on the control topic rereads selected.csv without restarting.
+    # {"command": "add", "nodes": [{"NodeId": ...}, ...]} and {"command": "remove", "NodeIds": [...]}
+    # change the selection in place.
+    def on_message(client, userdata, msg):
+        try:
+            message = json.loads(msg.payload)
+            command = message.get("command")
+        except Exception as e:
+            print(f"Error processing control message: {e}")
+            return
+        if command == "reload":
+            loop.call_soon_threadsafe(selection.request_reload)
+        elif command == "add":
+            loop.call_soon_threadsafe(selection.add, message.get("nodes", []))
+        elif command == "remove":
+            loop.call_soon_threadsafe(selection.remove, message.get("NodeIds", []))
+        else:
+            print(f"Unknown control command: {command}")
+
+    mqtt_client.message_callback_add(MQTT_CONTROL_TOPIC, on_message)
+
+def to_sample(key, data_value):
+    # (node_id, value, source timestamp in ms, status code) as carried by batched payloads.
+    timestamp = data_value.SourceTimestamp or data_value.ServerTimestamp
+    if timestamp is not None:
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp = int(timestamp.timestamp() * 1000)
+    status = data_value.StatusCode.value if data_value.StatusCode is not None else 0
+    return (key, data_value.Value.Value if data_value.Value is not None else None, timestamp, status)
+
+class SampleQueue:
+    # Bounded queue between the OPC UA readers and the MQTT publisher.
+    # policy: "block" waits for space, "drop_oldest"/"drop_newest" discard samples instead.
+    def __init__(self, maxsize, policy):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    async def put(self, sample):
+        if self.policy == "block":
+            await self.queue.put(sample)
+        else:
+            self.put_nowait(sample)
+
+    def put_nowait(self, sample):
+        try:
+            self.queue.put_nowait(sample)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.policy == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.put_nowait(sample)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_available(self, limit):
+        samples = []
+        while len(samples) < limit and not self.queue.empty():
+            samples.append(self.queue.get_nowait())
+        return samples
+
+    def describe(self):
+        return f"queue: {self.queue.qsize()}/{self.queue.maxsize}, dropped: {self.dropped}"
+
+class Publisher:
+    # Publishes sample batches to MQTT. With a spool, batches that cannot be handed to the
+    # broker go to disk and are replayed in order, in bulk and rate-limited, after reconnecting.
+    def __init__(self, mqtt_client, payload_format, max_samples, max_pending, spool=None):
+        self.mqtt_client = mqtt_client
+        self.payload_format = payload_format
+        self.max_samples = max_samples
+        self.max_pending = max_pending
+        self.spool = spool
+        self.pending = deque()
+        self.published = 0
+        self.spooled = 0
+        self.replayed = 0
+        # Samples paho refused without a spool to fall back on.
+        self.dropped = 0
+
+    async def wait_for_capacity(self):
+        # paho sends from its own network thread; cap the number of messages it has not
+        # yet written so a slow broker backs up into the sample queue instead of memory.
+        while True:
+            if not self.mqtt_client.is_connected():
+                self.pending.clear()
+                return
+            while self.pending and self.pending[0].is_published():
+                self.pending.popleft()
+            if len(self.pending) < self.max_pending:
+                return
+            await asyncio.sleep(0.01)
+
+    def publish(self, samples):
+        # Returns False if any message could not be queued with paho.
+        published = True
+        for mqtt_payload in encode_samples(samples, self.payload_format):
+            info = self.mqtt_client.publish(MQTT_TOPIC, mqtt_payload)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.pending.append(info)
+            else:
+                print(f"Error publishing {len(samples)} samples: {mqtt.error_string(info.rc)}")
+                published = False
+        return published
+
+    def store(self, samples):
+        if self.spool.empty():
+            print(f"MQTT broker unavailable, spooling samples to {self.spool.directory}")
+        self.spool.append(encode_samples(samples, "msgpack"))
+        self.spooled += len(samples)
+
+    async def run(self, sample_queue):
+        while True:
+            # Batched formats take everything queued since the last message, which is
+            # typically one read cycle or one subscription notification.
+            samples = [await sample_queue.get()]
+            samples.extend(sample_queue.get_available(self.max_samples - 1))
+            if self.spool is not None and (not self.mqtt_client.is_connected() or not self.spool.empty()):
+                # Broker is down, or older samples are still on disk; queue behind them to keep order.
+                self.store(samples)
+                continue
+            await self.wait_for_capacity()
             try:
-                value = opcua_client.get_node(node_id).get_value()
-                node_id_short = node_id.replace("ns=2;s=DB15.", "")
-                mqtt_payload = json.dumps({"node_id": node_id_short, "value": value})
-                mqtt_client.publish(MQTT_TOPIC, mqtt_payload)
-                print(f"Published: {node_id_short} = {value}")
+                if not self.publish(samples):
+                    if self.spool is not None:
+                        self.store(samples)
+                    else:
+                        self.dropped += len(samples)
+                    continue
+                self.published += len(samples)
+                if published_log.due():
+                    if self.payload_format == "single":
+                        published_log.print(f"Published: {samples[0][0]} = {samples[0][1]}")
+                    else:
+                        published_log.print(f"Published: {len(samples)} samples")
             except Exception as e:
-                print(f"Error reading {node_id}: {e}")
+                print(f"Error publishing {len(samples)} samples: {e}")
+                self.dropped += len(samples)
+
+    async def replay(self, replay_rate):
+        while True:
+            if self.spool.empty() or not self.mqtt_client.is_connected():
+                await asyncio.sleep(1)
+                continue
+            await self.wait_for_capacity()
+            # Each spooled record is one batch of samples; replay many of them per message.
+            samples = [sample for record in self.spool.read(SPOOL_REPLAY_RECORDS) for sample in decode_samples(record)]
+            if not all(self.publish(samples[i:i + self.max_samples]) for i in range(0, len(samples), self.max_samples)):
+                await asyncio.sleep(1)
+                continue
+            self.spool.commit()
+            self.replayed += len(samples)
+            if self.spool.empty():
+                print(f"Replayed spooled samples, {self.describe()}")
+            await asyncio.sleep(len(samples) / replay_rate)
+
+    def describe(self):
+        return f"spooled: {self.spooled}, replayed: {self.replayed}, {self.spool.describe()}" if self.spool is not None else ""
+
+async def report(sample_queue, publisher, selection):
+    # Counters for the app's supervisor; "samples" counts everything delivered to the broker.
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        group_cycle_times = [cycle_times[key] for key in selection.groups if key in cycle_times]
+        report_stats(
+            shard=SHARD_INDEX,
+            shards=SHARD_COUNT,
+            nodes=selection.size(),
+            cycle_ms=round(max(group_cycle_times), 1) if group_cycle_times else None,
+            samples=publisher.published + publisher.replayed,
+            published=publisher.published,
+            queue=sample_queue.queue.qsize(),
+            dropped=sample_queue.dropped + publisher.dropped,
+            spooled=publisher.spooled,
+            replayed=publisher.replayed,
+            spool_bytes=publisher.spool.size() if publisher.spool is not None else 0,
+            inflight=len(publisher.pending),
+            suppressed=counters["suppressed"],
+            heartbeats=counters["heartbeats"],
+            overruns=counters["overruns"],
+            histograms={name: histogram.snapshot() for name, histogram in histograms.items()},
+        )
+
+async def run_tasks(selection, keys, start):
+    # Keeps one task per key in keys() running, starting and cancelling tasks as the selection changes.
+    tasks = {}
+    try:
+        while True:
+            version = selection.version
+            wanted = keys()
+            for key in list(tasks):
+                if key not in wanted:
+                    tasks.pop(key).cancel()
+            for key in wanted:
+                if key not in tasks:
+                    tasks[key] = asyncio.create_task(start(key))
+            changed = asyncio.create_task(selection.wait_for_change(version))
+            done, _ = await asyncio.wait([changed, *tasks.values()], return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+            for key, task in list(tasks.items()):
+                if task in done:
+                    del tasks[key]
+                    task.result()
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+async def read_chunk(opcua_client, sample_queue, chunk):
+    # One Read service call for the whole chunk; bad nodes come back as per-item StatusCodes.
+    results = await opcua_client.read_attributes([node for _, node in chunk], ua.AttributeIds.Value)
+    errors = 0
+    now = time.monotonic()
+    for (selected, _), result in zip(chunk, results):
+        if not result.StatusCode.is_good():
+            if read_error_log.due():
+                read_error_log.print(f"Error reading {selected.node_id}: {result.StatusCode.name}")
+            errors += 1
+            continue
+        sample = to_sample(selected.key, result)
+        if selected.filter is not None and not selected.filter.passes(sample[1], sample[3], now):
+            counters["suppressed"] += 1
+            continue
+        await sample_queue.put(sample)
+    return errors
+
+async def read_opcua_data(opcua_client, selection, sample_queue, server_url, namespace):
+    name = f"{server_url} ns={namespace}{SHARD_LABEL}"
+    version = None
+    nodes = []
+    while True:
         read_interval = int(os.environ.get('READ_INTERVAL', DEFAULT_READ_INTERVAL))
-        time.sleep(read_interval)
+        chunk_size = max(1, int(os.environ.get('READ_CHUNK_SIZE', DEFAULT_READ_CHUNK_SIZE)))
+        cycle_start = time.monotonic()
+        if version != selection.version:
+            version = selection.version
+            # Reuse the Node objects of nodes that stay selected.
+            known = {selected.node_id: node for selected, node in nodes}
+            nodes = [(selected, known.get(selected.node_id) or opcua_client.get_node(selected.nodeid)) for selected in selection.nodes(server_url, namespace).values()]
+        chunk_latencies = []
+        errors = 0
+        for i in range(0, len(nodes), chunk_size):
+            chunk = nodes[i:i + chunk_size]
+            chunk_start = time.monotonic()
+            try:
+                errors += await read_chunk(opcua_client, sample_queue, chunk)
+            except (ConnectionError, asyncio.TimeoutError):
+                raise
+            except Exception as e:
+                print(f"Error reading chunk of {len(chunk)} nodes starting at {chunk[0][0].node_id}: {e}")
+                errors += len(chunk)
+            chunk_latencies.append((time.monotonic() - chunk_start) * 1000)
+            histograms["opcua_read_seconds"].observe(chunk_latencies[-1] / 1000)
+        cycle_duration = time.monotonic() - cycle_start
+        cycle_times[(server_url, namespace)] = cycle_duration * 1000
+        histograms["opcua_cycle_seconds"].observe(cycle_duration)
+        print(f"Cycle [{name}]: {len(nodes)} nodes in {cycle_duration * 1000:.1f} ms ({cycle_duration / read_interval * 100 if read_interval else 100:.1f}% of read interval), "
+              f"{len(chunk_latencies)} chunks, chunk latency: {', '.join(f'{latency:.1f}' for latency in chunk_latencies)} ms, errors: {errors}, {sample_queue.describe()}")
+        if cycle_duration > read_interval:
+            counters["overruns"] += 1
+            print(f"Cycle [{name}] overran read interval of {read_interval} s")
+        await asyncio.sleep(max(0, read_interval - cycle_duration))
+
+class SubscriptionHandler:
+    # Notifications cannot be held back, so a full queue always drops here, even with the "block" policy.
+    def __init__(self, sample_queue):
+        self.sample_queue = sample_queue
+        self.nodes = {}
+        # Set on a bad status change, e.g. BadShutdown when asyncua loses the connection.
+        self.lost = asyncio.Event()
+        self.status = None
+
+    def datachange_notification(self, node, val, data):
+        selected = self.nodes.get(node.nodeid)
+        if selected is None:
+            return
+        sample = to_sample(selected.key, data.monitored_item.Value)
+        if selected.filter is not None and not selected.filter.passes(sample[1], sample[3], time.monotonic()):
+            counters["suppressed"] += 1
+            return
+        self.sample_queue.put_nowait(sample)
+
+    def send_heartbeats(self):
+        # The server only notifies on change, so unchanged values are republished from here,
+        # stamped with the current time.
+        now = time.monotonic()
+        timestamp = int(time.time() * 1000)
+        for selected in self.nodes.values():
+            change_filter = selected.filter
+            if change_filter is not None and change_filter.heartbeat_due(now):
+                change_filter.last_time = now
+                counters["heartbeats"] += 1
+                self.sample_queue.put_nowait((selected.key, change_filter.last_value, timestamp, change_filter.last_status))
+
+    def event_notification(self, event):
+        pass
+
+    def status_change_notification(self, status):
+        status = getattr(status, "Status", status)
+        print(f"Subscription status changed: {status.name}")
+        if not status.is_good():
+            self.status = status
+            self.lost.set()
+
+def make_deadband_filter(deadband):
+    if deadband <= 0:
+        return None
+    deadband_filter = ua.DataChangeFilter()
+    deadband_filter.Trigger = ua.DataChangeTrigger.StatusValue
+    deadband_filter.DeadbandType = ua.DeadbandType.Absolute
+    deadband_filter.DeadbandValue = deadband
+    return deadband_filter
+
+def monitored_item_request(selected, client_handle, sampling_interval, deadband_filter):
+    request = ua.MonitoredItemCreateRequest()
+    request.ItemToMonitor = ua.ReadValueId()
+    request.ItemToMonitor.NodeId = selected.nodeid
+    request.ItemToMonitor.AttributeId = ua.AttributeIds.Value
+    request.MonitoringMode = ua.MonitoringMode.Reporting
+    request.RequestedParameters = ua.MonitoringParameters()
+    request.RequestedParameters.ClientHandle = client_handle
+    request.RequestedParameters.SamplingInterval = sampling_interval
+    request.RequestedParameters.QueueSize = 0
+    request.RequestedParameters.DiscardOldest = True
+    request.RequestedParameters.Filter = deadband_filter
+    return request
+
+async def subscribe_opcua_data(opcua_client, selection, sample_queue, server_url, namespace):
+    name = f"{server_url} ns={namespace}{SHARD_LABEL}"
+    publishing_interval = float(os.environ.get('PUBLISHING_INTERVAL', DEFAULT_PUBLISHING_INTERVAL))
+    sampling_interval = float(os.environ.get('SAMPLING_INTERVAL', DEFAULT_SAMPLING_INTERVAL))
+    deadband_filter = make_deadband_filter(float(os.environ.get('DEADBAND', DEFAULT_DEADBAND)))
+
+    handler = SubscriptionHandler(sample_queue)
+    subscription = await opcua_client.create_subscription(publishing_interval, handler)
+    handles = {}
+    client_handles = iter(range(1, 2 ** 32))
+    lost = asyncio.ensure_future(handler.lost.wait())
+    try:
+        while True:
+            # Apply the difference between the monitored items and the current selection.
+            version = selection.version
+            wanted = selection.nodes(server_url, namespace)
+            removed = [node_id for node_id in handles if node_id not in wanted]
+            added = [selected for node_id, selected in wanted.items() if node_id not in handles]
+            if removed:
+                await subscription.unsubscribe([handles[node_id][0] for node_id in removed])
+                for node_id in removed:
+                    handler.nodes.pop(handles.pop(node_id)[1], None)
+            # Nodes that stay monitored may come back from a reload with new settings or a new alias.
+            for selected in wanted.values():
+                handler.nodes[selected.nodeid] = selected
+            # The deadband only goes on numeric nodes; items the server still refuses it for are
+            # monitored again without it.
+            filters = [deadband_filter if selected.data_type in NUMERIC_DATA_TYPES else None for selected in added]
+            results = await subscription.create_monitored_items(
+                [monitored_item_request(selected, next(client_handles), sampling_interval, mfilter) for selected, mfilter in zip(added, filters)]) if added else []
+            retry = [index for index, result in enumerate(results) if isinstance(result, ua.StatusCode) and filters[index] is not None and result.value in FILTER_REJECTED]
+            if retry:
+                print(f"Server rejected the deadband for {len(retry)} nodes [{name}], monitoring them without it")
+                retried = await subscription.create_monitored_items([monitored_item_request(added[index], next(client_handles), sampling_interval, None) for index in retry])
+                for index, result in zip(retry, retried):
+                    results[index] = result
+            for selected, result in zip(added, results):
+                if isinstance(result, ua.StatusCode):
+                    print(f"Error subscribing {selected.node_id}: {result.name}")
+                    handler.nodes.pop(selected.nodeid, None)
+                else:
+                    handles[selected.node_id] = (result, selected.nodeid)
+            print(f"Subscribed [{name}] to {len(handles)}/{len(wanted)} nodes (+{len(added)}/-{len(removed)}, publishing interval: {publishing_interval} ms, sampling interval: {sampling_interval} ms)")
+            heartbeats = any(selected.filter is not None and selected.filter.heartbeat for selected in handler.nodes.values())
+            described = checked = time.monotonic()
+            changed = asyncio.ensure_future(selection.wait_for_change(version))
+            try:
+                while not changed.done():
+                    await asyncio.wait([changed, lost], timeout=HEARTBEAT_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                    # Raising hands the session back to run_server, which reconnects and subscribes again.
+                    if lost.done():
+                        raise ConnectionError(f"subscription [{name}] lost: {handler.status.name}")
+                    if changed.done():
+                        break
+                    if heartbeats:
+                        handler.send_heartbeats()
+                    if time.monotonic() - checked >= SESSION_CHECK_INTERVAL:
+                        checked = time.monotonic()
+                        await asyncio.wait_for(opcua_client.nodes.server_state.read_value(), SESSION_CHECK_TIMEOUT)
+                    if time.monotonic() - described >= 60:
+                        described = time.monotonic()
+                        print(f"Subscription [{name}]: {sample_queue.describe()}")
+            finally:
+                changed.cancel()
+    finally:
+        lost.cancel()
+        try:
+            await subscription.delete()
+        except Exception as e:
+            print(f"Error deleting subscription [{name}]: {e}")
+
+async def run_server(server_url, selection, sample_queue, acquisition_mode):
+    # One session per server; each namespace gets its own reader so they proceed concurrently.
+    acquire = subscribe_opcua_data if acquisition_mode == "subscription" else read_opcua_data
+    while True:
+        opcua_client = Client(server_url)
+        try:
+            await opcua_client.connect()
+            print(f"Connected to OPC UA server {server_url}")
+            await run_tasks(selection, lambda: selection.namespaces(server_url),
+                            lambda namespace: acquire(opcua_client, selection, sample_queue, server_url, namespace))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error on OPC UA server {server_url}: {e}, reconnecting in {RECONNECT_DELAY} s")
+        finally:
+            try:
+                await opcua_client.disconnect()
+            except Exception:
+                pass
+        await asyncio.sleep(RECONNECT_DELAY)
+
+async def run(mqtt_client):
+    acquisition_mode = os.environ.get('ACQUISITION_MODE', DEFAULT_ACQUISITION_MODE)
+    sample_queue = SampleQueue(
+        int(os.environ.get('QUEUE_SIZE', DEFAULT_QUEUE_SIZE)),
+        os.environ.get('QUEUE_FULL_POLICY', DEFAULT_QUEUE_FULL_POLICY),
+    )
+    payload_format = os.environ.get('PAYLOAD_FORMAT', DEFAULT_PAYLOAD_FORMAT)
+    if payload_format not in PAYLOAD_FORMATS:
+        print(f"Unknown payload format {payload_format}, using {DEFAULT_PAYLOAD_FORMAT}")
+        payload_format = DEFAULT_PAYLOAD_FORMAT
+    # The single format keeps sensor names for consumers that predate the registry.
+    selection = NodeSelection(SELECTED_CSV, ALIAS_FILE if payload_format != "single" else None)
+    loop = asyncio.get_running_loop()
+    # Installed before the first load: a SIGHUP from here on triggers one more reload, not a lost one.
+    loop.add_signal_handler(signal.SIGHUP, selection.request_reload)
+    selection.load()
+    # The supervisor stops converters with SIGTERM; cancel so subscriptions and sessions are closed.
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    subscribe_control(mqtt_client, selection, loop)
+
+    spool_max_bytes = int(os.environ.get('SPOOL_MAX_BYTES', DEFAULT_SPOOL_MAX_BYTES))
+    publisher = Publisher(
+        mqtt_client,
+        payload_format,
+        1 if payload_format == "single" else int(os.environ.get('PAYLOAD_MAX_SAMPLES', DEFAULT_PAYLOAD_MAX_SAMPLES)),
+        int(os.environ.get('MQTT_MAX_PENDING', DEFAULT_MQTT_MAX_PENDING)),
+        # Shards each need a spool of their own.
+        Spool(os.path.join(SPOOL_DIR, f"shard{SHARD_INDEX}") if SHARD_COUNT > 1 else SPOOL_DIR, spool_max_bytes) if spool_max_bytes > 0 else None,
+    )
+    replay = [publisher.replay(float(os.environ.get('SPOOL_REPLAY_RATE', DEFAULT_SPOOL_REPLAY_RATE)))] if publisher.spool is not None else []
+
+    await asyncio.gather(
+        publisher.run(sample_queue),
+        *replay,
+        report(sample_queue, publisher, selection),
+        selection.watch(),
+        run_tasks(selection, selection.servers,
+                  lambda server_url: run_server(server_url, selection, sample_queue, acquisition_mode)),
+    )
 
 def main():
+    # The app sends SIGHUP to reload the selection, possibly while connecting; ignore it until
+    # run() installs the reload handler instead of dying from it.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
     mqtt_client = connect_mqtt()
-    opcua_client = Client(OPC_SERVER_URL)
     try:
-        read_opcua_data(opcua_client, mqtt_client)
-    except KeyboardInterrupt:
+        asyncio.run(run(mqtt_client))
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print("Stopping...")
     finally:
-        opcua_client.disconnect()
+        mqtt_client.loop_stop()
         mqtt_client.disconnect()
         print("Disconnected from servers")
 
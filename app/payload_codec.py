@@ -0,0 +1,34 @@
+import json
+import msgpack
+
+# MQTT payload formats shared by both converters.
+#   single:  one {"node_id": ..., "value": ...} JSON message per sample (original format)
+#   json:    {"v": 1, "samples": [[node_id, value, timestamp_ms, status], ...]} as JSON
+#   msgpack: the same batch document encoded with MessagePack
+# timestamp_ms is the OPC UA source timestamp in milliseconds since the epoch (or None),
+# status is the numeric OPC UA StatusCode (0 = Good). In batches, node_id is the node's integer
+# alias when it has one in the app's alias registry (see alias_registry.py).
+PAYLOAD_FORMATS = ("single", "json", "msgpack")
+BATCH_VERSION = 1
+
+def encode_samples(samples, payload_format):
+    if payload_format == "single":
+        return [json.dumps({"node_id": node_id, "value": value}, default=str) for node_id, value, _, _ in samples]
+    document = {"v": BATCH_VERSION, "samples": [list(sample) for sample in samples]}
+    if payload_format == "msgpack":
+        return [msgpack.packb(document, default=str)]
+    return [json.dumps(document, separators=(',', ':'), default=str)]
+
+def decode_samples(payload):
+    # Returns a list of (node_id, value, timestamp_ms, status); the format is detected from the payload.
+    if payload[:1] == b'{':
+        try:
+            document = json.loads(payload)
+        except ValueError:
+            # Older publishers sent Python dict reprs with single quotes.
+            document = json.loads(payload.decode().replace("'", '"'))
+    else:
+        document = msgpack.unpackb(payload)
+    if "samples" in document:
+        return [tuple(sample) for sample in document["samples"]]
+    return [(document.get("node_id", "unknown_sensor"), document.get("value", 0), None, 0)]
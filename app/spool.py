@@ -0,0 +1,136 @@
+import os
+import struct
+
+# Store-and-forward buffer used by the converters while their sink is unreachable.
+# Records are appended to numbered segment files as length-prefixed blobs and read back
+# in order. Fully replayed segments are deleted, and the oldest segments are evicted when
+# the spool grows past max_bytes. The read position survives restarts in a small cursor file.
+# A Spool is not thread-safe; each converter only touches it from a single thread.
+
+RECORD_HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+class Spool:
+    def __init__(self, directory, max_bytes, segment_bytes=8 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        self.sizes = {segment: os.path.getsize(self._path(segment)) for segment in self.segments}
+        self.head_offset = 0
+        self.pending_read = None
+        self.evicted = 0
+        self._writer = None
+        self._load_cursor()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as file:
+                segment, offset = (int(part) for part in file.read().split())
+        except (OSError, ValueError):
+            return
+        if self.segments and segment == self.segments[0]:
+            self.head_offset = offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w") as file:
+            file.write(f"{self.segments[0] if self.segments else 0} {self.head_offset}")
+        os.replace(path + ".tmp", path)
+
+    def size(self):
+        return sum(self.sizes.values()) - self.head_offset
+
+    def empty(self):
+        return self.size() <= 0
+
+    def append(self, records):
+        # Segments left over from a previous run are only read, never appended to.
+        if self._writer is None or self.sizes[self.segments[-1]] >= self.segment_bytes:
+            self._roll()
+        data = b"".join(RECORD_HEADER.pack(len(record)) + record for record in records)
+        self._writer.write(data)
+        self._writer.flush()
+        self.sizes[self.segments[-1]] += len(data)
+        self._evict()
+
+    def _roll(self):
+        if self._writer:
+            self._writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+        self._writer = open(self._path(segment), "ab")
+
+    def _evict(self):
+        # Never evict the segment being written; drop the oldest ones first.
+        while self.size() > self.max_bytes and len(self.segments) > 1:
+            segment = self.segments.pop(0)
+            self.evicted += self.sizes.pop(segment) - self.head_offset
+            os.remove(self._path(segment))
+            self.head_offset = 0
+            self.pending_read = None
+            self._save_cursor()
+
+    def read(self, max_records, max_bytes=None):
+        # Returns up to max_records from the head without consuming them. Call commit() once they
+        # have been delivered, without appending in between.
+        records = []
+        size = 0
+        index = 0
+        offset = self.head_offset
+        while index < len(self.segments) and len(records) < max_records and (max_bytes is None or size < max_bytes):
+            segment = self.segments[index]
+            torn = False
+            with open(self._path(segment), "rb") as file:
+                file.seek(offset)
+                while len(records) < max_records and (max_bytes is None or size < max_bytes):
+                    header = file.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+                    length = RECORD_HEADER.unpack(header)[0] if len(header) == RECORD_HEADER.size else -1
+                    record = file.read(length) if length >= 0 else b""
+                    if length < 0 or len(record) < length:
+                        # A record cut short by a crash; skip the rest of this segment.
+                        torn = True
+                        break
+                    records.append(record)
+                    size += length
+                    offset = file.tell()
+            if offset < self.sizes[segment] and not (torn and (index < len(self.segments) - 1 or self._writer is None)):
+                break
+            index += 1
+            offset = 0
+        self.pending_read = (index, offset)
+        return records
+
+    def commit(self):
+        # Consumes everything returned by the last read().
+        if self.pending_read is None:
+            return
+        index, offset = self.pending_read
+        self.pending_read = None
+        if index >= len(self.segments):
+            # Everything has been replayed; the next append starts a fresh segment.
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            consumed, self.segments = self.segments, []
+            self.sizes.clear()
+            self.head_offset = 0
+        else:
+            consumed, self.segments = self.segments[:index], self.segments[index:]
+            for segment in consumed:
+                del self.sizes[segment]
+            self.head_offset = offset
+        for segment in consumed:
+            os.remove(self._path(segment))
+        self._save_cursor()
+
+    def describe(self):
+        return f"spool: {self.size()} bytes in {len(self.segments)} segments, evicted: {self.evicted} bytes"
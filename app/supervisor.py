@@ -0,0 +1,316 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import signal
+import time
+import psutil
+from .converter_stats import parse_stats
+
+RUN_DIR = "app/data/run"
+DESIRED_STATE_FILE = os.path.join(RUN_DIR, "desired.json")
+STOP_TIMEOUT = 10
+MIN_RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# A worker that stayed up this long is considered healthy again and restarts without backoff.
+STABLE_UPTIME = 60
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 3
+
+class ManagedProcess:
+    def __init__(self, name, script, log_file, args=(), env=None, log=None):
+        self.name = name
+        self.script = script
+        self.log_file = log_file
+        self.log = log or logging.getLogger(name)
+        self.args = list(args)
+        self.env = env or {}
+        self.desired = False
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit_code = None
+        self.stats = {}
+        self.throughput = 0.0
+        self._throughput_sample = None
+        self._psutil_process = None
+        self._task = None
+        self._on_change = None
+
+    @property
+    def label(self):
+        # Shards share a log file, so tell their lines apart.
+        return f"{self.script} [{self.name}]" if self.env.get("SHARD_COUNT") else self.script
+
+    @property
+    def pid_file(self):
+        return os.path.join(RUN_DIR, f"{self.name}.pid")
+
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def start(self):
+        if self.desired and self._task and not self._task.done():
+            return False
+        self.desired = True
+        self._task = asyncio.create_task(self._run())
+        self._notify()
+        return True
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        # SIGTERM first so the worker can flush and disconnect, SIGKILL if it does not exit in time.
+        if not self.desired and not self.is_running():
+            return False
+        self.desired = False
+        self._notify()
+        if self.is_running():
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{self.name} did not stop within {timeout} s, killing it")
+                self.process.kill()
+                await self.process.wait()
+            self.last_exit_code = self.process.returncode
+        if self._task and not self._task.done():
+            self._task.cancel()
+        try:
+            os.remove(self.pid_file)
+        except OSError:
+            pass
+        return True
+
+    async def restart(self):
+        await self.stop()
+        self.start()
+
+    def reload(self):
+        # The converters reread their configuration files on SIGHUP.
+        if self.is_running():
+            self.process.send_signal(signal.SIGHUP)
+            return True
+        return False
+
+    async def _run(self):
+        delay = MIN_RESTART_DELAY
+        while self.desired:
+            # Settings changed through the API live in os.environ, so merge it at every start.
+            self.process = await asyncio.create_subprocess_exec('python3', self.script, *self.args, env={**os.environ, **self.env},
+                                                                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            self.started_at = time.time()
+            self.stats = {}
+            self.throughput = 0.0
+            self._throughput_sample = None
+            self._psutil_process = None
+            with open(self.pid_file, 'w') as file:
+                file.write(str(self.process.pid))
+            await self._capture_output()
+            self.last_exit_code = await self.process.wait()
+            uptime = time.time() - self.started_at
+            try:
+                os.remove(self.pid_file)
+            except OSError:
+                pass
+            if not self.desired:
+                break
+            if uptime >= STABLE_UPTIME:
+                delay = MIN_RESTART_DELAY
+            self.restarts += 1
+            logging.error(f"{self.name} exited with code {self.last_exit_code} after {uptime:.0f} s, restarting in {delay} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    async def _capture_output(self):
+        # stdout and stderr are drained together so a full stderr pipe cannot block the child.
+        await asyncio.gather(self._capture_stream(self.process.stdout, ": "), self._capture_stream(self.process.stderr, " Error: "))
+
+    async def _capture_stream(self, stream, separator):
+        while True:
+            line = await stream.readline()
+            if not line: break
+            text = line.decode(errors='replace').rstrip()
+            stats = parse_stats(text)
+            if stats is not None:
+                self._update_stats(stats)
+                continue
+            self.log.info(f"{self.label}{separator}{text}")
+
+    def _update_stats(self, stats):
+        now = time.monotonic()
+        samples = stats.get("samples")
+        if samples is not None:
+            if self._throughput_sample is not None and now > self._throughput_sample[0]:
+                self.throughput = max(0.0, (samples - self._throughput_sample[1]) / (now - self._throughput_sample[0]))
+            self._throughput_sample = (now, samples)
+        self.stats = stats
+
+    def _notify(self):
+        if self._on_change:
+            self._on_change()
+
+    def status(self):
+        if self.is_running():
+            state = "running"
+        elif self.desired:
+            state = "restarting"
+        else:
+            state = "stopped"
+        status = {
+            "state": state,
+            "pid": self.process.pid if self.is_running() else None,
+            "uptime": round(time.time() - self.started_at, 1) if self.is_running() else 0,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+            "cpu_percent": None,
+            "rss_bytes": None,
+            "throughput": round(self.throughput, 1) if self.is_running() else 0.0,
+            "stats": self.stats,
+        }
+        if self.is_running():
+            try:
+                if self._psutil_process is None or self._psutil_process.pid != self.process.pid:
+                    self._psutil_process = psutil.Process(self.process.pid)
+                with self._psutil_process.oneshot():
+                    # cpu_percent is measured since the previous status() call.
+                    status["cpu_percent"] = self._psutil_process.cpu_percent(interval=None)
+                    status["rss_bytes"] = self._psutil_process.memory_info().rss
+            except psutil.Error:
+                pass
+        return status
+
+class WorkerGroup:
+    # The shards of one converter, controlled like a single worker.
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+
+    @property
+    def desired(self):
+        return any(worker.desired for worker in self.workers)
+
+    def start(self):
+        return any([worker.start() for worker in self.workers])
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        return any(await asyncio.gather(*[worker.stop(timeout) for worker in self.workers]))
+
+    async def restart(self):
+        await asyncio.gather(*[worker.restart() for worker in self.workers])
+
+    def reload(self):
+        return any([worker.reload() for worker in self.workers])
+
+    def status(self):
+        shards = {worker.name: worker.status() for worker in self.workers}
+        states = {status["state"] for status in shards.values()}
+        return {
+            "state": states.pop() if len(states) == 1 else "degraded",
+            "throughput": round(sum(status["throughput"] for status in shards.values()), 1),
+            "shards": shards,
+        }
+
+class Supervisor:
+    # Runs the converter scripts as child processes, restarts them with backoff when they
+    # crash and remembers which ones should be running across app restarts.
+    def __init__(self, log_max_bytes=DEFAULT_LOG_MAX_BYTES, log_backup_count=DEFAULT_LOG_BACKUP_COUNT):
+        self.workers = {}
+        self.groups = {}
+        self.log_max_bytes = log_max_bytes
+        self.log_backup_count = log_backup_count
+        self.logs = {}
+        self.log_writers = []
+        os.makedirs(RUN_DIR, exist_ok=True)
+
+    def add(self, name, script, log_file, args=(), env=None):
+        worker = ManagedProcess(name, script, log_file, args, env, self._log(log_file))
+        worker._on_change = self._save_desired_state
+        self.workers[name] = worker
+        return worker
+
+    def add_sharded(self, name, script, log_file, shards):
+        # Runs the script as shards named <name>.<index>; each gets SHARD_INDEX and SHARD_COUNT
+        # and picks its own part of the work.
+        if shards <= 1:
+            return self.add(name, script, log_file)
+        group = WorkerGroup(name, [self.add(f"{name}.{index}", script, log_file, env={"SHARD_INDEX": str(index), "SHARD_COUNT": str(shards)})
+                                   for index in range(shards)])
+        self.groups[name] = group
+        return group
+
+    def _log(self, log_file):
+        # One logger per file, so shards sharing a log file also share its rotation. The event loop
+        # only queues the records; a listener thread owns the open file and does the writing.
+        if log_file not in self.logs:
+            log = logging.getLogger(f"converter.{log_file}")
+            log.propagate = False
+            log.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=self.log_max_bytes, backupCount=self.log_backup_count)
+            handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+            records = queue.SimpleQueue()
+            log.addHandler(logging.handlers.QueueHandler(records))
+            writer = logging.handlers.QueueListener(records, handler)
+            writer.start()
+            self.log_writers.append(writer)
+            self.logs[log_file] = log
+        return self.logs[log_file]
+
+    def get(self, name):
+        # A single worker, a shard, or a whole group of shards.
+        return self.workers.get(name) or self.groups.get(name)
+
+    def _save_desired_state(self):
+        with open(DESIRED_STATE_FILE, 'w') as file:
+            json.dump([name for name, worker in self.workers.items() if worker.desired], file)
+
+    def recover(self):
+        # Workers left behind by a previous app instance cannot be re-attached (their output
+        # pipes are gone), so terminate them and start fresh ones for everything that was desired.
+        for worker in self.workers.values():
+            try:
+                with open(worker.pid_file) as file:
+                    pid = int(file.read())
+                process = psutil.Process(pid)
+                if worker.script in " ".join(process.cmdline()):
+                    logging.info(f"Terminating orphaned {worker.name} process {pid}")
+                    process.terminate()
+                    try:
+                        process.wait(STOP_TIMEOUT)
+                    except psutil.TimeoutExpired:
+                        process.kill()
+            except (OSError, ValueError, psutil.Error):
+                pass
+            try:
+                os.remove(worker.pid_file)
+            except OSError:
+                pass
+        try:
+            with open(DESIRED_STATE_FILE) as file:
+                desired = json.load(file)
+        except (OSError, ValueError):
+            desired = []
+        for name in desired:
+            if name in self.workers:
+                logging.info(f"Restarting {name} after app restart")
+                self.workers[name].start()
+
+    async def shutdown(self):
+        # Stop the workers but keep the desired state so they come back with the app.
+        for worker in self.workers.values():
+            worker._on_change = None
+        await asyncio.gather(*[worker.stop() for worker in self.workers.values()])
+        for worker in self.workers.values():
+            worker._on_change = self._save_desired_state
+        for writer in self.log_writers:
+            # Writes out whatever is still queued.
+            writer.stop()
+        self.log_writers = []
+
+    def statuses(self):
+        statuses = {name: worker.status() for name, worker in self.workers.items()}
+        for name, group in self.groups.items():
+            statuses[name] = group.status()
+            for shard in group.workers:
+                del statuses[shard.name]
+        return statuses
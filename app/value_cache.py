@@ -0,0 +1,92 @@
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# Latest value of every tag seen on the plant topic, so the app can serve current values without
+# querying InfluxDB. Each tag gets a slot; the fields live in parallel arrays indexed by slot.
+# Every update gets a sequence number, and slots are kept in update order, so "what changed since
+# seq N" only touches the changed slots.
+# Updates come from the paho network thread, reads from the event loop, hence the lock.
+RATE_SMOOTHING = 0.2
+
+def quality(status):
+    # Severity bits of an OPC UA StatusCode.
+    return ("good", "uncertain", "bad", "bad")[(status >> 30) & 3]
+
+class ValueCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.names = []
+        self.values = []
+        self.timestamps = array('d')
+        self.received = array('d')
+        self.statuses = array('q')
+        self.intervals = array('d')
+        self.seqs = array('q')
+        self.order = OrderedDict()
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, samples):
+        # samples: (node_id, value, timestamp_ms, status) tuples as decoded by payload_codec.
+        now = time.time()
+        with self.lock:
+            for name, value, timestamp, status in samples:
+                slot = self.slots.get(name)
+                if slot is None:
+                    slot = self.slots[name] = len(self.names)
+                    self.names.append(name)
+                    self.values.append(value)
+                    self.timestamps.append(timestamp or now * 1000)
+                    self.received.append(now)
+                    self.statuses.append(status or 0)
+                    self.intervals.append(0.0)
+                    self.seqs.append(0)
+                else:
+                    interval = now - self.received[slot]
+                    self.intervals[slot] = interval if not self.intervals[slot] else self.intervals[slot] + RATE_SMOOTHING * (interval - self.intervals[slot])
+                    self.values[slot] = value
+                    self.timestamps[slot] = timestamp or now * 1000
+                    self.received[slot] = now
+                    self.statuses[slot] = status or 0
+                self.seq += 1
+                self.seqs[slot] = self.seq
+                self.order[slot] = None
+                self.order.move_to_end(slot)
+
+    def get(self, node_ids=None, query=None):
+        # Returns (seq, rows) for the given tags, or all tags matching query (a substring of the name).
+        with self.lock:
+            if node_ids is not None:
+                slots = [self.slots[node_id] for node_id in node_ids if node_id in self.slots]
+            else:
+                slots = range(len(self.names))
+            return self.seq, [self._row(slot) for slot in slots if not query or query in self.names[slot]]
+
+    def changes(self, since, node_ids=None, query=None):
+        # Returns (seq, rows) for the tags updated after sequence number since, oldest first.
+        with self.lock:
+            changed = []
+            for slot in reversed(self.order):
+                if self.seqs[slot] <= since:
+                    break
+                changed.append(slot)
+            wanted = set(node_ids) if node_ids is not None else None
+            return self.seq, [self._row(slot) for slot in reversed(changed)
+                              if (wanted is None or self.names[slot] in wanted) and (not query or query in self.names[slot])]
+
+    def _row(self, slot):
+        interval = self.intervals[slot]
+        return {
+            "node_id": self.names[slot],
+            "value": self.values[slot],
+            "timestamp": int(self.timestamps[slot]),
+            "status": self.statuses[slot],
+            "quality": quality(self.statuses[slot]),
+            "received": round(self.received[slot], 3),
+            "rate": round(1 / interval, 3) if interval else None,
+        }
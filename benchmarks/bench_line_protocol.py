@@ -0,0 +1,59 @@
+"""Compares the MQTT to InfluxDB ingestion paths per sample.
+
+    python benchmarks/bench_line_protocol.py [samples] [sensors]
+
+point:       JSON payload per sample -> Point -> line protocol (the previous path)
+line:        JSON payload per sample -> cached prefix line protocol
+line+batch:  one MessagePack batch payload -> cached prefix line protocol
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from influxdb_client import Point, WritePrecision
+from line_protocol import LineEncoder
+from payload_codec import decode_samples, encode_samples
+
+def point_path(payloads):
+    lines = []
+    for payload in payloads:
+        for sensor_name, value, timestamp, status in decode_samples(payload):
+            point = Point("sensor_data").tag("sensor", sensor_name).field("value", float(value))
+            lines.append(point.to_line_protocol(precision=WritePrecision.MS).encode())
+    return b"\n".join(lines)
+
+def line_path(payloads, encoder):
+    lines = []
+    for payload in payloads:
+        for sensor_name, value, timestamp, status in decode_samples(payload):
+            line = encoder.encode(sensor_name, value, timestamp, status)
+            if line is not None:
+                lines.append(line)
+    return b"\n".join(lines)
+
+def measure(name, func, samples):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {elapsed * 1000:9.1f} ms  {samples / elapsed:12,.0f} samples/s")
+    return elapsed
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    data = [(f"R{i % sensors}_XTT610_Manteltemp", 20.0 + i % 100 / 10, 1700000000000 + i, 0) for i in range(samples)]
+    single = [payload.encode() for payload in encode_samples(data, "single")]
+    batches = [payload for i in range(0, samples, sensors) for payload in encode_samples(data[i:i + sensors], "msgpack")]
+
+    print(f"{samples} samples over {sensors} sensors")
+    baseline = measure("point", lambda: point_path(single), samples)
+    encoder = LineEncoder()
+    line_path(single[:sensors], encoder)  # warm the prefix cache like a running converter
+    fast = measure("line", lambda: line_path(single, encoder), samples)
+    batched = measure("line+batch", lambda: line_path(batches, encoder), samples)
+    print(f"line is {baseline / fast:.1f}x, line+batch {baseline / batched:.1f}x faster than point")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""End-to-end load test: OPC UA simulator -> opcua_to_MQTT_Converter -> MQTT -> mqtt_to_Influx_Converter -> InfluxDB.
+
+    python benchmarks/bench_pipeline.py [--nodes 5000] [--depth 2] [--change-rate 1.0]
+                                        [--mode poll|subscription] [--payload msgpack] [--read-interval 1]
+                                        [--aliases] [--downsample 1,10] [--aggregates-only] [--warmup 5] [--duration 20] [--skip-browse] [--json results.json]
+
+Everything runs locally: the OPC UA server is simulated (standins.OpcUaSimulator, in its own
+process), the broker and InfluxDB are replaced by standins.MqttBroker and standins.InfluxSink, and
+both converter scripts run unchanged, pointed at them through OPCUA_SERVER_URL, MQTT_BROKER,
+MQTT_PORT, INFLUXDB_URL, SELECTED_CSV and ALIAS_FILE. With --aliases the bench plays the app's part:
+it writes an alias registry for the selection and retains it on the broker. --downsample and
+--aggregates-only set DOWNSAMPLE_WINDOWS and DOWNSAMPLE_RAW=0 for the InfluxDB converter. Reports NodeCSVExporter
+browse/export nodes/s, samples/s arriving at InfluxDB, MQTT messages and bytes/s, source timestamp ->
+InfluxDB lag percentiles, and CPU/RSS per component.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from NodeCsvExporter import NodeCSVExporter
+from alias_registry import AliasRegistry
+from line_protocol import LineEncoder
+from standins import InfluxSink, MqttBroker, OpcUaSimulator
+
+MQTT_ALIAS_TOPIC = "opcua_to_mqtt/aliases"
+CONVERTERS = {
+    "opcua_to_mqtt": "app/opcua_to_MQTT_Converter.py",
+    "mqtt_to_influx": "app/mqtt_to_Influx_Converter.py",
+}
+
+def run_simulator(connection, port, nodes, depth, change_rate):
+    async def serve():
+        simulator = await OpcUaSimulator(port, nodes, depth, change_rate).start()
+        connection.send(simulator.node_ids())
+        await simulator.run_changes()
+    asyncio.run(serve())
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+async def browse(url, directory):
+    output_file = os.path.join(directory, "nodes_output.csv")
+    exporter = NodeCSVExporter(url, output_file, print_callback=lambda message: None, nodes_file=os.path.join(directory, "nodes.csv"))
+    start = time.perf_counter()
+    await exporter.import_nodes()
+    browsed = time.perf_counter()
+    await exporter.export_csv()
+    exported = time.perf_counter()
+    with open(output_file, newline='') as file:
+        count = sum(1 for _ in csv.DictReader(file))
+    return {
+        "nodes": count,
+        "browse_seconds": round(browsed - start, 3),
+        "browse_nodes_per_second": round(count / (browsed - start)),
+        "export_seconds": round(exported - browsed, 3),
+        "export_nodes_per_second": round(count / (exported - browsed)),
+    }
+
+async def pipeline(args, url, node_ids, directory, simulator_pid):
+    broker = await MqttBroker().start()
+    sink = await InfluxSink().start()
+    selected_csv = os.path.join(directory, "selected.csv")
+    rows = [{"DisplayName": node_id.rsplit('.', 1)[-1], "NodeId": node_id, "DataType": "Double"} for node_id in node_ids]
+    with open(selected_csv, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=["DisplayName", "NodeId", "DataType"])
+        writer.writeheader()
+        writer.writerows(rows)
+    # Without --aliases the file does not exist and samples carry sensor names.
+    alias_file = os.path.join(directory, "aliases.json")
+    if args.aliases:
+        registry = AliasRegistry()
+        registry.update(rows, LineEncoder("sensor_data", "sensor").series_key)
+        registry.save(alias_file)
+        broker.retained[MQTT_ALIAS_TOPIC] = registry.dumps().encode()
+    env = {
+        **os.environ,
+        "OPCUA_SERVER_URL": url,
+        "MQTT_BROKER": "127.0.0.1",
+        "MQTT_PORT": str(broker.port),
+        "INFLUXDB_URL": f"http://127.0.0.1:{sink.port}",
+        "INFLUX_TOKEN": "bench",
+        "SELECTED_CSV": selected_csv,
+        "ALIAS_FILE": alias_file,
+        "SPOOL_MAX_BYTES": "0",
+        "READ_INTERVAL": str(args.read_interval),
+        "ACQUISITION_MODE": args.mode,
+        "PAYLOAD_FORMAT": args.payload,
+        "PYTHONUNBUFFERED": "1",
+        "DOWNSAMPLE_WINDOWS": args.downsample or "",
+        "DOWNSAMPLE_RAW": "0" if args.aggregates_only else "1",
+    }
+    processes = {}
+    try:
+        for name, script in CONVERTERS.items():
+            log = open(os.path.join(directory, f"{name}.log"), 'w')
+            processes[name] = subprocess.Popen([sys.executable, script], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        await asyncio.sleep(args.warmup)
+        for name, process in processes.items():
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} exited with code {process.returncode}, see {directory}/{name}.log")
+
+        monitored = {name: psutil.Process(process.pid) for name, process in processes.items()}
+        monitored["simulator"] = psutil.Process(simulator_pid)
+        monitored["broker+sink"] = psutil.Process(os.getpid())
+        for process in monitored.values():
+            process.cpu_percent(None)
+        peak_rss = dict.fromkeys(monitored, 0)
+        sink.reset()
+        messages = broker.messages
+        mqtt_bytes = broker.bytes
+        start = time.monotonic()
+        while time.monotonic() - start < args.duration:
+            await asyncio.sleep(1)
+            for name, process in monitored.items():
+                peak_rss[name] = max(peak_rss[name], process.memory_info().rss)
+        elapsed = time.monotonic() - start
+        lags = sorted(sink.lags)
+        return {
+            "samples_per_second": round(sink.points / elapsed),
+            "mqtt_messages_per_second": round((broker.messages - messages) / elapsed),
+            "mqtt_bytes_per_second": round((broker.bytes - mqtt_bytes) / elapsed),
+            "influx_writes_per_second": round(sink.writes / elapsed, 1),
+            "lag_seconds": {name: round(percentile(lags, fraction), 3) if lags else None
+                            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+            "components": {name: {"cpu_percent": round(process.cpu_percent(None), 1), "peak_rss_mb": round(peak_rss[name] / 1024 / 1024, 1)}
+                           for name, process in monitored.items()},
+        }
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await broker.stop()
+        await sink.stop()
+
+async def bench(args, url, node_ids, simulator_pid):
+    directory = tempfile.mkdtemp(prefix="bench_pipeline_")
+    results = {"settings": vars(args)}
+    if not args.skip_browse:
+        results["browse"] = await browse(url, directory)
+        browse_results = results["browse"]
+        print(f"browse:   {browse_results['nodes']} nodes in {browse_results['browse_seconds']} s ({browse_results['browse_nodes_per_second']:,} nodes/s), "
+              f"export {browse_results['export_seconds']} s ({browse_results['export_nodes_per_second']:,} nodes/s)")
+    results["pipeline"] = await pipeline(args, url, node_ids, directory, simulator_pid)
+    pipeline_results = results["pipeline"]
+    lag = pipeline_results["lag_seconds"]
+    print(f"pipeline: {len(node_ids)} nodes, {args.mode}, {args.payload}{', aliases' if args.aliases else ''}{f', downsample {args.downsample}' if args.downsample else ''}{' only' if args.aggregates_only else ''}, change rate {args.change_rate}/s, {args.duration} s")
+    print(f"          {pipeline_results['samples_per_second']:,} samples/s into InfluxDB, {pipeline_results['mqtt_messages_per_second']:,} MQTT messages/s "
+          f"({pipeline_results['mqtt_bytes_per_second']:,} bytes/s), {pipeline_results['influx_writes_per_second']} writes/s")
+    if lag["p50"] is not None:
+        print(f"          lag p50 {lag['p50']} s, p90 {lag['p90']} s, p99 {lag['p99']} s, max {lag['max']} s")
+    print(f"{'component':<16} {'cpu %':>7} {'peak rss MB':>12}")
+    for name, usage in pipeline_results["components"].items():
+        print(f"{name:<16} {usage['cpu_percent']:>7} {usage['peak_rss_mb']:>12}")
+    shutil.rmtree(directory)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=5000)
+    parser.add_argument("--depth", type=int, default=2, help="folder levels between DB15 and the variables")
+    parser.add_argument("--change-rate", type=float, default=1.0, help="fraction of the variables changed per second")
+    parser.add_argument("--mode", choices=("poll", "subscription"), default="poll")
+    parser.add_argument("--payload", choices=("single", "json", "msgpack"), default="msgpack")
+    parser.add_argument("--read-interval", type=int, default=1)
+    parser.add_argument("--aliases", action="store_true", help="publish alias registry aliases instead of sensor names")
+    parser.add_argument("--downsample", help="aggregate windows in seconds for the InfluxDB converter, e.g. 1,10")
+    parser.add_argument("--aggregates-only", action="store_true", help="with --downsample, do not write the raw samples")
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--port", type=int, default=48500, help="OPC UA simulator port")
+    parser.add_argument("--skip-browse", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    connection, child_connection = multiprocessing.Pipe()
+    simulator = multiprocessing.Process(target=run_simulator, args=(child_connection, args.port, args.nodes, args.depth, args.change_rate), daemon=True)
+    simulator.start()
+    try:
+        node_ids = connection.recv()
+        results = asyncio.run(bench(args, f"opc.tcp://127.0.0.1:{args.port}", node_ids, simulator.pid))
+    finally:
+        simulator.terminate()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
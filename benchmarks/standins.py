@@ -0,0 +1,261 @@
+"""Local stand-ins for the plant OPC UA server, the MQTT broker and InfluxDB, used by bench_pipeline.py.
+
+OpcUaSimulator: asyncua server with a tree of Double variables under DB15, changing at a set rate.
+MqttBroker:     just enough MQTT 3.1.1 for paho: QoS 0/1/2 publish, subscribe with wildcards, retained messages.
+InfluxSink:     HTTP server accepting /api/v2/write, counting points and measuring the lag from each
+                point's timestamp to its arrival.
+"""
+import asyncio
+import gzip
+import time
+from datetime import datetime, timezone
+
+from asyncua import Server, ua
+
+class OpcUaSimulator:
+    def __init__(self, port, nodes, depth=2, change_rate=1.0, tick=0.1):
+        # change_rate: fraction of the variables written per second.
+        self.url = f"opc.tcp://127.0.0.1:{port}"
+        self.nodes = nodes
+        self.depth = depth
+        self.change_rate = change_rate
+        self.tick = tick
+        self.server = None
+        self.variables = []
+        self.writes = 0
+
+    async def start(self):
+        self.server = Server()
+        await self.server.init()
+        self.server.set_endpoint(self.url)
+        namespace = await self.server.register_namespace("urn:bench")
+        root = await self.server.nodes.objects.add_object(ua.NodeId("DB15", namespace), "DB15")
+        # Spread the variables evenly over depth levels of folders.
+        fanout = max(1, round(self.nodes ** (1 / (self.depth + 1)))) if self.depth else 1
+        parents = [(root, "DB15")]
+        for level in range(self.depth):
+            children = []
+            for parent, path in parents:
+                for index in range(fanout):
+                    child_path = f"{path}.F{level}_{index}"
+                    children.append((await parent.add_folder(ua.NodeId(child_path, namespace), f"F{level}_{index}"), child_path))
+            parents = children
+        for index in range(self.nodes):
+            parent, path = parents[index % len(parents)]
+            variable = await parent.add_variable(ua.NodeId(f"{path}.Tag{index}", namespace), f"Tag{index}", float(index))
+            self.variables.append(variable.nodeid)
+        await self.server.start()
+        return self
+
+    def node_ids(self):
+        return [nodeid.to_string() for nodeid in self.variables]
+
+    async def run_changes(self):
+        # Writes round-robin through the variables, stamping each value with the current time.
+        position = 0
+        per_tick = self.nodes * self.change_rate * self.tick
+        owed = 0.0
+        while True:
+            started = time.monotonic()
+            owed += per_tick
+            count = int(owed)
+            owed -= count
+            now = datetime.now(timezone.utc)
+            for _ in range(count):
+                nodeid = self.variables[position]
+                position = (position + 1) % self.nodes
+                self.writes += 1
+                await self.server.write_attribute_value(nodeid, ua.DataValue(ua.Variant(float(self.writes), ua.VariantType.Double), SourceTimestamp=now, ServerTimestamp=now))
+            await asyncio.sleep(max(0, self.tick - (time.monotonic() - started)))
+
+    async def stop(self):
+        await self.server.stop()
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(levels) or (level != '+' and level != levels[index]):
+            return False
+    return len(levels) == len(filter_levels)
+
+def _string(data, offset):
+    length = int.from_bytes(data[offset:offset + 2], 'big')
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+def _packet(packet_type, body, flags=0):
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([packet_type << 4 | flags]) + bytes(encoded) + body
+
+def _publish(topic, payload, retain=False):
+    topic = topic.encode()
+    return _packet(3, len(topic).to_bytes(2, 'big') + topic + payload, 1 if retain else 0)
+
+class MqttBroker:
+    # Subscribers get every message at QoS 0. Slow subscribers slow down the publishers, as with
+    # a real broker's in-flight limits.
+    WRITE_BUFFER_LIMIT = 1024 * 1024
+
+    def __init__(self, port=0):
+        self.port = port
+        self.server = None
+        self.sessions = {}
+        self.retained = {}
+        self.messages = 0
+        self.bytes = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._session, "127.0.0.1", self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.sessions):
+            writer.close()
+        # Let the session handlers see their connections close before the loop goes away.
+        await asyncio.sleep(0.1)
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0f, await reader.readexactly(length)
+
+    async def _session(self, reader, writer):
+        self.sessions[writer] = []
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == 1:
+                    writer.write(_packet(2, b"\x00\x00"))
+                elif packet_type == 3:
+                    qos = (flags >> 1) & 3
+                    topic, offset = _string(body, 0)
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(_packet(4 if qos == 1 else 5, packet_id))
+                    payload = body[offset:]
+                    if flags & 1:
+                        if payload:
+                            self.retained[topic] = payload
+                        else:
+                            self.retained.pop(topic, None)
+                    await self._forward(topic, payload)
+                elif packet_type == 6:
+                    writer.write(_packet(7, body[:2]))
+                elif packet_type == 8:
+                    packet_id = body[:2]
+                    offset = 2
+                    topic_filters = []
+                    while offset < len(body):
+                        topic_filter, offset = _string(body, offset)
+                        topic_filters.append(topic_filter)
+                        offset += 1
+                    self.sessions[writer].extend(topic_filters)
+                    writer.write(_packet(9, packet_id + bytes(len(topic_filters))))
+                    for topic, payload in self.retained.items():
+                        if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                            writer.write(_publish(topic, payload, retain=True))
+                elif packet_type == 10:
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = _string(body, offset)
+                        if topic_filter in self.sessions[writer]:
+                            self.sessions[writer].remove(topic_filter)
+                    writer.write(_packet(11, body[:2]))
+                elif packet_type == 12:
+                    writer.write(_packet(13, b""))
+                elif packet_type == 14:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.sessions[writer]
+            writer.close()
+
+    async def _forward(self, topic, payload):
+        self.messages += 1
+        self.bytes += len(payload)
+        packet = None
+        for writer, filters in list(self.sessions.items()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                packet = packet or _publish(topic, payload)
+                writer.write(packet)
+                if writer.transport.get_write_buffer_size() > self.WRITE_BUFFER_LIMIT:
+                    try:
+                        await writer.drain()
+                    except ConnectionError:
+                        pass
+
+class InfluxSink:
+    def __init__(self, port=0):
+        self.port = port
+        self.server = None
+        self.connections = set()
+        self.reset()
+
+    def reset(self):
+        self.points = 0
+        self.writes = 0
+        self.lags = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._connection, "127.0.0.1", self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.sleep(0.1)
+
+    async def _connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                lines = request.decode('latin-1').split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {name.lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:] if line)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if headers.get("content-encoding") == "gzip":
+                    body = gzip.decompress(body)
+                if path.startswith("/api/v2/write"):
+                    self._record(body)
+                writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def _record(self, body):
+        # Lines are written with millisecond timestamps; lines without one only count.
+        now = time.time() * 1000
+        self.writes += 1
+        for line in body.split(b"\n"):
+            if not line:
+                continue
+            self.points += 1
+            timestamp = line[line.rindex(b" ") + 1:]
+            if b",status=" in line and timestamp.isdigit():
+                self.lags.append((now - int(timestamp)) / 1000)
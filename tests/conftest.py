@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app is imported as the "app" package, as uvicorn runs it (app.main:app).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
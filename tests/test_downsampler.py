@@ -0,0 +1,30 @@
+from app.downsampler import Downsampler, parse_windows
+
+def make_downsampler(lines):
+    downsampler = Downsampler(parse_windows("10,60"), lines.append, lambda series, suffix: series + suffix.encode() + b" ")
+    # Oldest open window: [10 s, 20 s); started by hand so no thread runs.
+    downsampler.open_end = 20000
+    return downsampler
+
+def test_window_aggregates():
+    lines = []
+    downsampler = make_downsampler(lines)
+    downsampler.add([b"a", b"a", b"b"], [1.0, 3.0, 5.0], [11000, 12000, 15000])
+    downsampler._drain()
+    downsampler._close(20000)
+    assert lines == [b"a_10s min=1.0,max=3.0,mean=2.0,last=3.0,count=2i 10000",
+                     b"b_10s min=5.0,max=5.0,mean=5.0,last=5.0,count=1i 10000"]
+
+def test_late_samples_leave_open_window_alone():
+    lines = []
+    downsampler = make_downsampler(lines)
+    downsampler.add([b"a"], [1.0], [15000])
+    downsampler._drain()
+    capacity = downsampler.capacity
+    # E.g. replayed from a spool: its window was written already.
+    downsampler.add([b"a"] * 100, [100.0] * 100, [5000] * 100)
+    downsampler._drain()
+    assert downsampler.late == 100
+    assert downsampler.capacity == capacity
+    downsampler._close(20000)
+    assert lines == [b"a_10s min=1.0,max=1.0,mean=1.0,last=1.0,count=1i 10000"]
@@ -0,0 +1,80 @@
+import csv
+
+import pytest
+
+from app.node_catalog import NodeCatalog
+
+NODES = [
+    {"NodeId": "ns=2;s=DB15", "BrowseName": "DB15", "ParentNodeId": "", "DataType": "", "DisplayName": "DB15", "Description": ""},
+    {"NodeId": "ns=2;s=DB15.R202_XTT610_Manteltemp", "BrowseName": "R202_XTT610_Manteltemp", "ParentNodeId": "ns=2;s=DB15",
+     "DataType": "Float", "DisplayName": "R202_XTT610_Manteltemp", "Description": ""},
+    {"NodeId": "ns=2;s=DB15.R201_XTT610_Manteltemp", "BrowseName": "R201_XTT610_Manteltemp", "ParentNodeId": "ns=2;s=DB15",
+     "DataType": "Float", "DisplayName": "R201_XTT610_Manteltemp", "Description": ""},
+    {"NodeId": "ns=2;s=DB15.F101_Running", "BrowseName": "F101_Running", "ParentNodeId": "ns=2;s=DB15",
+     "DataType": "Boolean", "DisplayName": "F101_Running", "Description": ""},
+]
+
+@pytest.fixture
+def catalog(tmp_path):
+    path = tmp_path / "nodes_output.csv"
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(NODES[0]))
+        writer.writeheader()
+        writer.writerows(NODES)
+    catalog = NodeCatalog(str(tmp_path / "node_catalog.sqlite"))
+    catalog.load_csv(str(path))
+    # Selected nodes carry their own display_name and data_type columns, which search must not confuse with the nodes' ones.
+    catalog.set_selection([{"NodeId": "ns=2;s=DB15.R202_XTT610_Manteltemp", "DisplayName": "R202_XTT610_Manteltemp", "DataType": "Float"}])
+    return catalog
+
+def node_ids(result):
+    nodes, _ = result
+    return [node["NodeId"] for node in nodes]
+
+def test_search_without_filter(catalog):
+    nodes, next_cursor = catalog.search()
+    assert [node["NodeId"] for node in nodes] == [node["NodeId"] for node in NODES]
+    assert next_cursor is None
+    assert [node["selected"] for node in nodes] == [False, True, False, False]
+    assert nodes[1]["DataType"] == "Float" and nodes[1]["ParentNodeId"] == "ns=2;s=DB15"
+
+def test_search_prefix(catalog):
+    assert node_ids(catalog.search("R20", match="prefix")) == ["ns=2;s=DB15.R202_XTT610_Manteltemp", "ns=2;s=DB15.R201_XTT610_Manteltemp"]
+
+def test_search_substring(catalog):
+    # Trigram index for three or more characters, a scan for shorter terms.
+    assert node_ids(catalog.search("XTT610")) == ["ns=2;s=DB15.R202_XTT610_Manteltemp", "ns=2;s=DB15.R201_XTT610_Manteltemp"]
+    assert node_ids(catalog.search("Ru")) == ["ns=2;s=DB15.F101_Running"]
+
+def test_search_data_type(catalog):
+    assert node_ids(catalog.search(data_type="Boolean")) == ["ns=2;s=DB15.F101_Running"]
+
+def test_search_parent(catalog):
+    assert node_ids(catalog.search(parent_id="ns=2;s=DB15")) == [node["NodeId"] for node in NODES[1:]]
+
+def test_search_selected(catalog):
+    assert node_ids(catalog.search(selected=True)) == ["ns=2;s=DB15.R202_XTT610_Manteltemp"]
+    assert len(node_ids(catalog.search("Manteltemp", selected=False))) == 1
+
+def test_search_pages(catalog):
+    first, cursor = catalog.search(limit=2)
+    second, _ = catalog.search(cursor=cursor, limit=2)
+    assert [node["NodeId"] for node in first + second] == [node["NodeId"] for node in NODES]
+
+def test_selection_rows_keep_optional_columns(catalog):
+    # /update rebuilds the selection from NodeIds; nodes that stay selected keep Deadband,
+    # Heartbeat and ServerUrl, and selected nodes missing from the catalog keep their row.
+    catalog.set_selection([
+        {"NodeId": "ns=2;s=DB15.R202_XTT610_Manteltemp", "DisplayName": "R202_XTT610_Manteltemp", "DataType": "Float",
+         "Deadband": "0.5", "Heartbeat": "300", "ServerUrl": "opc.tcp://plant2:4840"},
+        {"NodeId": "ns=2;s=DB16.Missing", "DisplayName": "Missing", "DataType": "Double", "Deadband": "2%"},
+    ])
+    rows = catalog.selection_rows(["ns=2;s=DB15.R202_XTT610_Manteltemp", "ns=2;s=DB16.Missing", "ns=2;s=DB15.F101_Running", "ns=2;s=Unknown"])
+    catalog.set_selection(rows)
+    assert list(catalog.selected_rows()) == [
+        {"DisplayName": "R202_XTT610_Manteltemp", "NodeId": "ns=2;s=DB15.R202_XTT610_Manteltemp", "DataType": "Float",
+         "ServerUrl": "opc.tcp://plant2:4840", "Deadband": "0.5", "Heartbeat": "300"},
+        {"DisplayName": "Missing", "NodeId": "ns=2;s=DB16.Missing", "DataType": "Double", "Deadband": "2%"},
+        {"DisplayName": "F101_Running", "NodeId": "ns=2;s=DB15.F101_Running", "DataType": "Boolean"},
+    ]
+    assert catalog.optional_columns() == ["ServerUrl", "Deadband", "Heartbeat"]
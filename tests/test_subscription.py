@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from asyncua import ua
+
+# The converters run as scripts from app/ and import their helper modules top-level.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import opcua_to_MQTT_Converter as converter  # noqa: E402
+
+class FakeSubscription:
+    def __init__(self, handler):
+        self.handler = handler
+        self.deleted = False
+
+    async def create_monitored_items(self, requests):
+        return list(range(len(requests)))
+
+    async def unsubscribe(self, handles):
+        pass
+
+    async def delete(self):
+        self.deleted = True
+
+class FakeClient:
+    def __init__(self):
+        self.subscription = None
+
+    async def create_subscription(self, publishing_interval, handler):
+        self.subscription = FakeSubscription(handler)
+        return self.subscription
+
+class FakeSelection:
+    version = 0
+
+    def nodes(self, server_url, namespace):
+        return {"ns=2;s=DB15.Temp": converter.SelectedNode("ns=2;s=DB15.Temp", ua.NodeId.from_string("ns=2;s=DB15.Temp"), data_type="Float")}
+
+    async def wait_for_change(self, version):
+        await asyncio.Event().wait()
+
+def test_subscription_exits_on_bad_status():
+    async def scenario():
+        client = FakeClient()
+        task = asyncio.create_task(converter.subscribe_opcua_data(client, FakeSelection(), converter.SampleQueue(10, "block"), "opc.tcp://plant:4840", 2))
+        while client.subscription is None or not client.subscription.handler.nodes:
+            await asyncio.sleep(0.01)
+        # What asyncua sends its subscriptions when the connection is lost.
+        client.subscription.handler.status_change_notification(ua.StatusChangeNotification(Status=ua.StatusCode(ua.StatusCodes.BadShutdown)))
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(task, 1)
+        assert client.subscription.deleted
+
+    asyncio.run(scenario())